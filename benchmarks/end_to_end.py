@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Time shared_stack.py against a local, synthetic distribution server and a
+stand-in EUPS, without touching the network or building anything.
+
+For each scale (a number of tags and products), three scenarios are run:
+
+- ``repository``: load a RepositoryManager from the server, serially and
+  with ``FETCH_WORKERS`` parallel downloads;
+- ``queries``: query the loaded tracker for every tag and product;
+- ``main``: populate a new stack with ``main()``, then run ``main()`` again
+  when there is nothing left to do.
+
+Results may be saved as JSON and compared with an earlier run::
+
+  $ python benchmarks/end_to_end.py --save before.json
+  $ python benchmarks/end_to_end.py --compare before.json
+"""
+from __future__ import print_function
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import shared_stack  # noqa: E402
+from fixtures import PkgrootServer, make_pkgroot, make_stack  # noqa: E402
+
+
+def timed(func, *args, **kwargs):
+    """
+    Return the result of calling ``func`` and the time it took.
+    """
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def bench_repository(url, results):
+    rm, results["repository serial"] = timed(
+        shared_stack.RepositoryManager, url, workers=1)
+    rm, results["repository parallel"] = timed(
+        shared_stack.RepositoryManager, url)
+    return rm
+
+
+def bench_queries(rm, results):
+    tags = sorted(rm.tag_dates)
+    products = set()
+    start = time.time()
+    for tag in tags:
+        products.update(rm.products_for_tag(tag))
+    results["queries products_for_tag"] = time.time() - start
+
+    start = time.time()
+    for product in products:
+        rm.tags_for_product(product)
+    results["queries tags_for_product"] = time.time() - start
+
+
+def bench_main(url, pkgroot_dir, work_dir, results):
+    stack_dir = os.path.join(work_dir, "stack")
+    make_stack(stack_dir)
+    eups_log = os.path.join(work_dir, "eups.log")
+    os.environ["FAKE_PKGROOT_DIR"] = pkgroot_dir
+    os.environ["FAKE_EUPS_LOG"] = eups_log
+    shared_stack.REPOSITORY_SNAPSHOT = os.path.join(work_dir,
+                                                    "repository.json.gz")
+
+    for name in ("main install", "main update"):
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            unused, results[name] = timed(shared_stack.main, stack_dir,
+                                          pkgroot=url)
+        results[name + " eups calls"] = 0
+        if os.path.exists(eups_log):
+            with open(eups_log) as f:
+                results[name + " eups calls"] = len(f.readlines())
+            os.unlink(eups_log)
+
+
+def run(scales, latency, scenarios):
+    """
+    Run ``scenarios`` at each of ``scales`` (a list of (tags, products)),
+    returning a dictionary of results keyed by "<tags>x<products> <name>".
+    """
+    os.environ["FAKE_EUPS_LATENCY"] = str(latency)
+    shared_stack.VERSION_GLOB = r"w_\d{4}_\d\d"
+    shared_stack.HTTP_CACHE_DIR = None
+
+    results = {}
+    for n_tags, n_products in scales:
+        scale = "%dx%d" % (n_tags, n_products)
+        work_dir = tempfile.mkdtemp()
+        try:
+            pkgroot_dir = os.path.join(work_dir, "pkgroot")
+            make_pkgroot(pkgroot_dir, n_tags, n_products)
+            scale_results = {}
+            with PkgrootServer(pkgroot_dir) as server:
+                if "repository" in scenarios or "queries" in scenarios:
+                    rm = bench_repository(server.url, scale_results)
+                    if "queries" in scenarios:
+                        bench_queries(rm, scale_results)
+                if "main" in scenarios:
+                    bench_main(server.url, pkgroot_dir, work_dir,
+                               scale_results)
+            shared_stack.http_client.close()
+        finally:
+            shutil.rmtree(work_dir)
+        for name, value in sorted(scale_results.items()):
+            print("%-10s %-32s %10s" % (scale, name, format_value(value)))
+            results["%s %s" % (scale, name)] = value
+    return results
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return "%.4f s" % (value,)
+    return str(value)
+
+
+def compare(results, previous):
+    """
+    Print each result alongside that from a previous run.
+    """
+    print("\n%-43s %10s %10s %7s" % ("", "previous", "current", "ratio"))
+    for name in sorted(set(results) | set(previous)):
+        before, after = previous.get(name), results.get(name)
+        ratio = ""
+        if before and after:
+            ratio = "%.2fx" % (float(after) / before,)
+        print("%-43s %10s %10s %7s" %
+              (name, format_value(before) if before is not None else "-",
+               format_value(after) if after is not None else "-", ratio))
+
+
+def parse_scale(text):
+    n_tags, n_products = text.split("x")
+    return int(n_tags), int(n_products)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scales", nargs="+", type=parse_scale,
+                        default=[(5, 20), (10, 50), (20, 100)],
+                        metavar="TAGSxPRODUCTS",
+                        help="sizes of synthetic repository to test")
+    parser.add_argument("--scenarios", nargs="+",
+                        choices=["repository", "queries", "main"],
+                        default=["repository", "queries", "main"])
+    parser.add_argument("--eups-latency", type=float, default=0.0,
+                        help="seconds the stand-in eups takes per call and "
+                             "per product installed")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare",
+                        help="compare with results saved by an earlier run")
+    args = parser.parse_args()
+
+    results = run(args.scales, args.eups_latency, args.scenarios)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "eups_latency": args.eups_latency,
+                       "results": results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+A stand-in for the EUPS Python package, implementing just enough of its
+behaviour (on a real ``ups_db`` layout) for benchmarking shared_stack.py.
+"""
+from __future__ import print_function
+
+import os
+import time
+
+__all__ = ["Eups", "Product"]
+
+PSEUDO_TAGS = ["newest", "setup"]
+BUILTIN_TAGS = ["current", "stable"]
+
+
+def _record(args):
+    log = os.environ.get("FAKE_EUPS_LOG")
+    if log:
+        with open(log, "a") as f:
+            f.write("%d %s\n" % (os.getpid(), " ".join(args)))
+
+
+def _latency():
+    time.sleep(float(os.environ.get("FAKE_EUPS_LATENCY", "0")))
+
+
+def _flavor():
+    return os.environ.get("EUPS_FLAVOR", "Linux64")
+
+
+class Product(object):
+    def __init__(self, name, version, tags):
+        self.name = name
+        self.version = version
+        self.tags = tags
+
+
+class Tags(object):
+    def __init__(self, eups):
+        self._eups = eups
+
+    def getTagNames(self, omitPseudo=False):
+        names = set(BUILTIN_TAGS)
+        startup = os.path.join(self._eups.path[0], "site", "startup.py")
+        if os.path.exists(startup):
+            with open(startup) as f:
+                for line in f:
+                    if "globalTags" in line and '"' in line:
+                        names.add(line.split('"')[1])
+        for product in self._eups.findProducts():
+            names.update(product.tags)
+        names = sorted(names)
+        if not omitPseudo:
+            names = PSEUDO_TAGS + names
+        return names
+
+
+class Eups(object):
+    def __init__(self, path=None, **kwargs):
+        self.path = (path or os.environ["EUPS_PATH"]).split(":")
+        self.flavor = _flavor()
+        self.tags = Tags(self)
+
+    @staticmethod
+    def setEupsPath(path=None, dbz=None):
+        return (path or __import__("os").environ["EUPS_PATH"]).split(":")
+
+    def _db(self, root=None):
+        return os.path.join(root or self.path[0], "ups_db")
+
+    def findProducts(self, name=None, version=None, tags=None):
+        results = []
+        for root in self.path:
+            db = self._db(root)
+            if not os.path.isdir(db):
+                continue
+            for product in sorted(os.listdir(db)):
+                if name and product != name:
+                    continue
+                pdir = os.path.join(db, product)
+                chains = {}
+                for entry in os.listdir(pdir):
+                    if entry.endswith(".chain"):
+                        with open(os.path.join(pdir, entry)) as f:
+                            for line in f:
+                                if line.strip().startswith("VERSION ="):
+                                    chains.setdefault(
+                                        line.split("=", 1)[1].strip(),
+                                        []).append(entry[:-6])
+                for entry in sorted(os.listdir(pdir)):
+                    if not entry.endswith(".version"):
+                        continue
+                    v = entry[:-8]
+                    if version and v != version:
+                        continue
+                    results.append(Product(product, v,
+                                           sorted(chains.get(v, []))))
+        return results
+
+    def declare(self, productName, versionName, productDir=None, tag=None):
+        pdir = os.path.join(self._db(), productName)
+        if not os.path.isdir(pdir):
+            os.makedirs(pdir)
+        if productDir is None:
+            productDir = os.path.join(self.flavor, productName, versionName)
+        with open(os.path.join(pdir, versionName + ".version"), "w") as f:
+            f.write("FILE = version\nPRODUCT = %s\nVERSION = %s\n"
+                    "#***************************************\n\n"
+                    "GROUP:\n   FLAVOR = %s\n   QUALIFIERS = \"\"\n"
+                    "   PROD_DIR = %s\n   UPS_DIR = ups\n"
+                    "   TABLE_FILE = %s.table\nEnd:\n" %
+                    (productName, versionName, self.flavor, productDir,
+                     productName))
+        if tag:
+            self.assignTag(tag, productName, versionName)
+
+    def assignTag(self, tag, productName, versionName=None):
+        pdir = os.path.join(self._db(), productName)
+        if not os.path.exists(os.path.join(pdir, versionName + ".version")):
+            raise RuntimeError("%s %s is not declared" %
+                               (productName, versionName))
+        with open(os.path.join(pdir, tag + ".chain"), "w") as f:
+            f.write("FILE = chain\nPRODUCT = %s\nCHAIN = %s\n"
+                    "#***************************************\n\n"
+                    "#Group:\n   FLAVOR = %s\n   VERSION = %s\n"
+                    "   QUALIFIERS = \"\"\n#End:\n" %
+                    (productName, tag, self.flavor, versionName))
+
+    def unassignTag(self, tag, productName, versionName=None):
+        chain = os.path.join(self._db(), productName, tag + ".chain")
+        if os.path.exists(chain):
+            os.unlink(chain)
+
+    def undeclare(self, productName, versionName):
+        pdir = os.path.join(self._db(), productName)
+        os.unlink(os.path.join(pdir, versionName + ".version"))
+        for entry in os.listdir(pdir):
+            if entry.endswith(".chain"):
+                path = os.path.join(pdir, entry)
+                with open(path) as f:
+                    if "VERSION = %s\n" % (versionName,) in f.read():
+                        os.unlink(path)
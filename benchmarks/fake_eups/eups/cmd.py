@@ -0,0 +1,132 @@
+"""
+Command-line interface of the stand-in EUPS package.
+"""
+from __future__ import print_function
+
+import os
+import sys
+
+import eups
+from eups import _latency, _record
+
+
+def _read_list(path):
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith("EUPS") or line.startswith("#") or \
+                    not line.strip():
+                continue
+            product, flavor, version = line.split()
+            entries.append((product, version))
+    return entries
+
+
+class EupsCmd(object):
+    def __init__(self, args=None, toolname=None, cmd=None):
+        if args is None:
+            args = sys.argv[1:]
+        self.args = [a for a in args if a != "--nolocks"]
+        self.toolname = toolname or "eups"
+
+    def run(self):
+        _record(self.args)
+        _latency()
+        cmd, args = self.args[0], self.args[1:]
+        try:
+            return getattr(self, "_" + cmd)(args) or 0
+        except Exception as e:
+            print("%s %s: %s" % (self.toolname, cmd, e), file=sys.stderr)
+            return 2
+
+    def _options(self, args, *with_values):
+        opts, positional = {}, []
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg in with_values:
+                opts[arg] = args.pop(0)
+            elif arg.startswith("-"):
+                opts[arg] = True
+            else:
+                positional.append(arg)
+        return opts, positional
+
+    def _list(self, args):
+        opts, positional = self._options(args, "-t", "--tag")
+        name = positional[0] if positional else None
+        version = positional[1] if len(positional) > 1 else None
+        for p in eups.Eups().findProducts(name, version):
+            if "--raw" in opts:
+                print("%s|%s|%s" % (p.name, p.version, ":".join(p.tags)))
+            else:
+                print("   %-20s %s" % (p.name, " ".join([p.version] +
+                                                          p.tags)))
+
+    def _tags(self, args):
+        print(" ".join(eups.Eups().tags.getTagNames()))
+
+    def _declare(self, args):
+        opts, positional = self._options(args, "-t", "--tag", "-r")
+        e = eups.Eups()
+        tag = opts.get("-t") or opts.get("--tag")
+        if len(positional) == 2 and tag and "-r" not in opts:
+            e.assignTag(tag, positional[0], positional[1])
+        else:
+            e.declare(positional[0], positional[1], opts.get("-r"), tag)
+
+    def _undeclare(self, args):
+        opts, positional = self._options(args, "-t", "--tag")
+        e = eups.Eups()
+        tag = opts.get("-t") or opts.get("--tag")
+        if tag:
+            e.unassignTag(tag, positional[0], positional[1])
+        else:
+            e.undeclare(positional[0], positional[1])
+
+    def _distrib(self, args):
+        sub, args = args[0], args[1:]
+        if sub != "install":
+            raise RuntimeError("unsupported: distrib %s" % (sub,))
+        opts, positional = self._options(args, "-t", "--tag")
+        pkgroot = os.environ["FAKE_PKGROOT_DIR"]
+        tag = opts.get("-t") or opts.get("--tag")
+        e = eups.Eups()
+        if tag:
+            wanted = _read_list(os.path.join(pkgroot, "tags", tag + ".list"))
+        else:
+            product, version = positional[0], positional[1]
+            manifest = os.path.join(pkgroot, "manifests",
+                                    "%s-%s.manifest" % (product, version))
+            wanted = [(product, version)]
+            if os.path.exists(manifest):
+                wanted = _read_manifest(manifest)
+        installed = set((p.name, p.version) for p in e.findProducts())
+        for product, version in wanted:
+            if (product, version) in installed:
+                continue
+            prod_dir = os.path.join(e.path[0], e.flavor, product, version)
+            for sub_dir in ("ups", os.path.join("python", product)):
+                if not os.path.isdir(os.path.join(prod_dir, sub_dir)):
+                    os.makedirs(os.path.join(prod_dir, sub_dir))
+            with open(os.path.join(prod_dir, "ups", product + ".table"),
+                      "w") as f:
+                f.write("setupRequired(base)\n")
+            with open(os.path.join(prod_dir, "python", product,
+                                   "__init__.py"), "w") as f:
+                f.write("VERSION = %r\n" % (version,))
+            _latency()
+            e.declare(product, version)
+            print("  [ %s %s ] installed" % (product, version))
+
+
+def _read_manifest(path):
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith("EUPS") or line.startswith("#") or \
+                    not line.strip():
+                continue
+            fields = line.split()
+            entries.append((fields[0], fields[2]))
+    return entries
@@ -0,0 +1,24 @@
+"""
+Customization hooks of the stand-in EUPS package.
+"""
+
+
+class _Config(object):
+    pass
+
+
+config = _Config()
+config.site = _Config()
+config.site.lockDirectoryBase = None
+config.Eups = _Config()
+config.Eups.globalTags = []
+
+
+def loadCustomization(verbose=0, path=[], **kwargs):
+    for root in path:
+        startup = root + "/site/startup.py"
+        try:
+            with open(startup) as f:
+                exec(f.read(), {"hooks": __import__("eups.hooks").hooks})
+        except IOError:
+            pass
@@ -0,0 +1,191 @@
+"""
+Offline stand-ins for the services shared_stack.py talks to.
+
+- ``make_pkgroot()`` generates a synthetic EUPS distribution server tree
+  (tag lists, an Apache-style tag index, manifests and package files);
+- ``PkgrootServer`` serves such a tree over HTTP/1.1 from a background thread;
+- ``make_stack()`` creates a stack whose ``eups`` command and Python package
+  are the stand-in in ``fake_eups``, which records each call it receives (to
+  ``$FAKE_EUPS_LOG``) and sleeps for ``$FAKE_EUPS_LATENCY`` seconds per call
+  and per product installed, "installing" products from the tree named by
+  ``$FAKE_PKGROOT_DIR``.
+"""
+from __future__ import print_function
+
+import functools
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_EUPS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "fake_eups", "eups")
+
+# Stand-in for EUPS's setups.sh: "setup" sets up only the current version of
+# the product named, without its dependencies.
+SETUPS_SH = """
+export EUPS_PATH=%(stack_dir)s
+export EUPS_DIR=%(stack_dir)s/eups
+export PATH=%(stack_dir)s/eups/bin:$PATH
+export PYTHONPATH=%(stack_dir)s/eups/python${PYTHONPATH:+:$PYTHONPATH}
+
+setup() {
+    version=$(eups list --raw "$1" |
+              awk -F'|' '$3 ~ /(^|:)current(:|$)/ { print $2 }')
+    [ -n "$version" ] || return 1
+    prod_dir=$EUPS_PATH/${EUPS_FLAVOR:-Linux64}/$1/$version
+    export PATH=$prod_dir/bin:$PATH
+    export PYTHONPATH=$prod_dir/python${PYTHONPATH:+:$PYTHONPATH}
+    export SETUP_$(echo "$1" | tr a-z A-Z)="$1 $version"
+}
+"""
+
+
+def tag_name(n):
+    """
+    Return the name of the ``n``th tag generated, a weekly which matches the
+    default ``VERSION_GLOB`` for the first 52.
+    """
+    return "w_%d_%02d" % (2016 + n // 52, n % 52 + 1)
+
+
+def make_pkgroot(root, n_tags, n_products, churn=0.2, seed=1):
+    """
+    Write a distribution server tree with ``n_tags`` weekly tags of
+    ``n_products`` products (plus ``lsst_distrib``, which depends on all of
+    them) to ``root``.
+
+    Each product depends on up to three others; a fraction ``churn`` of
+    products change version from one tag to the next.
+    """
+    for sub_dir in ("tags", "manifests", "products"):
+        if not os.path.isdir(os.path.join(root, sub_dir)):
+            os.makedirs(os.path.join(root, sub_dir))
+    rng = random.Random(seed)
+    names = ["p%04d" % (i,) for i in range(n_products)]
+    direct = dict((name, sorted(rng.sample(names[:i], min(i, 3))))
+                  for i, name in enumerate(names))
+    direct["lsst_distrib"] = list(names)
+
+    closures = {}
+
+    def closure(name):
+        # Dependencies of name, in the order in which they must be installed.
+        if name not in closures:
+            result = []
+            for dep in direct[name]:
+                for p in closure(dep) + [dep]:
+                    if p not in result:
+                        result.append(p)
+            closures[name] = result
+        return closures[name]
+
+    versions = dict((name, 1) for name in names)
+    start = time.mktime((2016, 1, 5, 20, 12, 0, 0, 0, 0))
+    index_lines = []
+    written = set()
+    for n in range(n_tags):
+        tag = tag_name(n)
+        for name in names:
+            if rng.random() < churn:
+                versions[name] += 1
+        current = dict((name, "%d.0+%d" % (v, v))
+                       for name, v in versions.items())
+        current["lsst_distrib"] = "12.0+%d" % (n,)
+
+        path = os.path.join(root, "tags", tag + ".list")
+        with open(path, "w") as f:
+            f.write("EUPS distribution %s version list. Version 1.0\n"
+                    "#product flavor version\n#--------\n" % (tag,))
+            for name in names + ["lsst_distrib"]:
+                f.write("%s generic %s\n" % (name, current[name]))
+        mtime = start + n * 7 * 86400
+        os.utime(path, (mtime, mtime))
+        index_lines.append('<a href="%s.list">%s.list</a>  %s  %.1fK  ' %
+                           (tag, tag,
+                            time.strftime("%d-%b-%Y %H:%M",
+                                          time.gmtime(mtime)),
+                            os.path.getsize(path) / 1024.0))
+
+        for name in names + ["lsst_distrib"]:
+            if (name, current[name]) in written:
+                continue
+            written.add((name, current[name]))
+            manifest = os.path.join(root, "manifests", "%s-%s.manifest" %
+                                    (name, current[name]))
+            with open(manifest, "w") as f:
+                f.write("EUPS distribution manifest for %s (%s). "
+                        "Version 1.0\n#\n# pkg flavor version tablefile "
+                        "installation_directory installID\n#----\n" %
+                        (name, current[name]))
+                for p in closure(name) + [name]:
+                    f.write(" %-20s generic %-12s %s/%s/ups/%s.table %s/%s "
+                            "eupspkg:%s-%s.eupspkg\n" %
+                            (p, current[p], p, current[p], p, p, current[p],
+                             p, current[p]))
+            package = os.path.join(root, "products", "%s-%s.eupspkg" %
+                                   (name, current[name]))
+            with open(package, "wb") as f:
+                f.write(b"\0" * rng.randint(1, 64) * 1024)
+
+    with open(os.path.join(root, "tags", "index.html"), "w") as f:
+        f.write('<html><head><title>Index of /tags</title></head><body>\n'
+                '<h1>Index of /tags</h1><pre>      '
+                '<a href="?C=N;O=D">Name</a>   '
+                '<a href="?C=M;O=A">Last modified</a> <hr>'
+                '<a href="/">Parent Directory</a>  -\n' +
+                "\n".join(index_lines) + "\n<hr></pre>\n</body></html>\n")
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PkgrootServer(object):
+    """
+    Serve the directory ``root`` over HTTP on a free local port until
+    ``close()`` is called. Usable as a context manager.
+    """
+    def __init__(self, root):
+        handler = functools.partial(_QuietHandler, directory=root)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        self.url = "http://127.0.0.1:%d/" % (self._server.server_address[1],)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def make_stack(stack_dir):
+    """
+    Create an empty stack in ``stack_dir`` using the stand-in EUPS.
+    """
+    for sub_dir in ("eups/bin", "eups/python", "site", "ups_db"):
+        os.makedirs(os.path.join(stack_dir, sub_dir))
+    shutil.copytree(FAKE_EUPS,
+                    os.path.join(stack_dir, "eups", "python", "eups"),
+                    ignore=shutil.ignore_patterns("__pycache__", "*.pyc"))
+    eups = os.path.join(stack_dir, "eups", "bin", "eups")
+    with open(eups, "w") as f:
+        f.write("#!%s\nimport sys\nimport eups.cmd\n"
+                "sys.exit(eups.cmd.EupsCmd().run())\n" % (sys.executable,))
+    os.chmod(eups, 0o755)
+    with open(os.path.join(stack_dir, "eups", "bin", "setups.sh"), "w") as f:
+        f.write(SETUPS_SH % {"stack_dir": stack_dir})
+    open(os.path.join(stack_dir, "site", "startup.py"), "w").close()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Compare the memory used by ProductTracker and CompactProductTracker.
+
+A synthetic repository resembling a broad ``VERSION_GLOB`` (a few years of
+weeklies plus releases, each listing every product in the stack) is loaded
+into each tracker, and the memory allocated while doing so is measured with
+``tracemalloc``. Every (product, version, tag) entry is built from freshly
+created strings, as it would be when parsing tag lists.
+
+Usage::
+
+  $ python benchmarks/tracker_memory.py [--tags N] [--products M]
+"""
+from __future__ import print_function
+
+import os
+import random
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from shared_stack import CompactProductTracker, ProductTracker  # noqa: E402
+
+
+def synthetic_tags(n_tags, n_products, churn=0.2, seed=0):
+    """
+    Yield (tag, [(product, version), ...]) for ``n_tags`` tags of
+    ``n_products`` products each; a fraction ``churn`` of products change
+    version from one tag to the next.
+    """
+    rng = random.Random(seed)
+    versions = dict(("product_%04d" % (i,), 0) for i in range(n_products))
+    for n in range(n_tags):
+        for product in versions:
+            if rng.random() < churn:
+                versions[product] += 1
+        if n % 10 == 9:
+            tag = "v%d_%d" % (n // 52 + 12, n % 52 // 10)
+        else:
+            tag = "w_%d_%02d" % (2016 + n // 52, n % 52 + 1)
+        yield tag, [(product, "12.0-%d-g%07x" % (v, v * 7919))
+                    for product, v in sorted(versions.items())]
+
+
+def load(tracker_class, tags):
+    tracker = tracker_class()
+    for tag, entries in tags:
+        for product, version in entries:
+            # Copy the strings, so that nothing is shared with the source
+            # data, as when the entries are parsed from a download.
+            tracker.insert("".join(product), "".join(version), "".join(tag))
+    return tracker
+
+
+def measure(tracker_class, tags):
+    """
+    Return the tracker loaded from ``tags``, the memory it retains, the peak
+    memory used while loading it and the time taken to load it (measured
+    separately, since tracing memory slows loading down).
+    """
+    start = time.time()
+    load(tracker_class, tags)
+    elapsed = time.time() - start
+
+    tracemalloc.start()
+    tracker = load(tracker_class, tags)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return tracker, current, peak, elapsed
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tags", type=int, default=150)
+    parser.add_argument("--products", type=int, default=1000)
+    args = parser.parse_args()
+
+    tags = list(synthetic_tags(args.tags, args.products))
+    n_entries = sum(len(entries) for tag, entries in tags)
+    print("%d tags x %d products = %d entries" %
+          (args.tags, args.products, n_entries))
+
+    results = {}
+    for tracker_class in (ProductTracker, CompactProductTracker):
+        tracker, current, peak, elapsed = measure(tracker_class, tags)
+        results[tracker_class.__name__] = tracker, current
+        print("%-22s %8.1f MiB retained %8.1f MiB peak %6.2f s to load" %
+              (tracker_class.__name__, current / 2.0**20, peak / 2.0**20,
+               elapsed))
+
+    reference = results["ProductTracker"][0]
+    compact = results["CompactProductTracker"][0]
+    for tag, entries in tags[::10]:
+        assert (sorted(reference.products_for_tag(tag)) ==
+                sorted(compact.products_for_tag(tag)))
+    for product, version in tags[0][1][::50]:
+        assert (reference.tags_for_product(product) ==
+                compact.tags_for_product(product))
+    print("Reduction: %.1fx" % (float(results["ProductTracker"][1]) /
+                                results["CompactProductTracker"][1]))
+
+
+if __name__ == "__main__":
+    main()
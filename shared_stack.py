@@ -54,33 +54,81 @@ maintainance procedure is followed:
 - Sort the installed tags by date they were created on the server and tag the
   most recent as "current".
 
-This tool requires Python (tested with 2.6, 2.7 and 3.5) and `lxml
-<http://lxml.de/>`_; the latter may be conveniently installed using ``pip``::
-
-  $ pip install -r requirements.txt
+This tool requires Python 2.7 or 3 (tested with 2.7 and 3.5); it has no
+dependencies beyond the standard library.
 
 With the exception of the target directory, which can be over-ridden on the
-command line, all configuration is performed by editing the ``CONFIGURATION``
-block below.
+command line (more than once, to maintain several stacks), all configuration
+is performed by editing the ``CONFIGURATION`` block below.
 """
 from __future__ import print_function
 
+import base64
+import fcntl
+import gzip
+import hashlib
+import io
+import json
 import os
 import shutil
 import re
 import subprocess
 import tarfile
+import socket
+import stat
+import sys
 import tempfile
+import threading
+import time
+import traceback
+import zlib
 from argparse import ArgumentParser
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-# from lxml import html
+from multiprocessing.pool import ThreadPool
 from textwrap import dedent
 try:
     # Python 3
-    from urllib.request import urlopen
+    from html.parser import HTMLParser
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib.error import HTTPError
+    from urllib.parse import unquote, urljoin, urlsplit
+    from urllib.request import getproxies, proxy_bypass
+except ImportError:
+    # Python 2
+    from HTMLParser import HTMLParser
+    from httplib import HTTPConnection, HTTPException, HTTPSConnection
+    from urllib import getproxies, proxy_bypass, unquote
+    from urllib2 import HTTPError
+    from urlparse import urljoin, urlsplit
+try:
+    # Python 3
+    from queue import Queue
 except ImportError:
     # Python 2
-    from urllib2 import urlopen
+    from Queue import Queue
+try:
+    # Python 3.5+
+    from os import scandir
+except ImportError:
+    try:
+        # Backport, if installed
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    # Python 3
+    from sys import intern
+except ImportError:
+    # Python 2: intern is a builtin
+    pass
+
+# datetime.strptime() imports this module on first use. In Python 2, that
+# import fails if another thread holds the import lock, as it may when tags are
+# read in parallel, so we import it up front.
+import _strptime  # noqa: E402,F401
 
 #
 # CONFIGURATION
@@ -105,6 +153,17 @@ MINICONDA2_VERSION = "3.19.0.lsst4"
 # Miniconda defined above.
 ANACONDA_VERSION = "2.5.0"
 
+# Changes made to the Anaconda installation, in order, when creating a stack:
+# a list of (action, [package specifications]) tuples. Each entry is applied
+# as a single conda transaction. The ``anaconda`` metapackage pins exact
+# builds (using MKL), so replacing them with the nomkl builds needs a
+# separate transaction.
+CONDA_ENVIRONMENT = [
+    ("install", ["anaconda=%s" % (ANACONDA_VERSION,)]),
+    ("install", ["nomkl", "numpy", "scipy", "scikit-learn", "numexpr"]),
+    ("remove", ["mkl", "mkl-service"]),
+]
+
 # Top-level products to install into the stack.
 PRODUCTS = ["lsst_distrib"]
 
@@ -116,6 +175,162 @@ ROOT = '/ssd/lsstsw/stack'
 # are matched, the slower things will be.
 VERSION_GLOB = r"w_2016_\d\d|v12_\d(_rc\d)?"
 
+# Set to True to drive EUPS through its Python API, imported from the stack,
+# within this process where possible, rather than starting the ``eups``
+# command for every operation. Falls back to the command if the API cannot be
+# loaded.
+EUPS_IN_PROCESS = False
+
+# Set to True to read the state of the stack directly from the EUPS database
+# (``ups_db``) rather than by running ``eups list``. Up to ``UPS_DB_WORKERS``
+# products are read simultaneously.
+READ_UPS_DB = True
+UPS_DB_WORKERS = 4
+
+# Number of tag lists to download from ``EUPS_PKGROOT`` simultaneously. Set to
+# 1 to fetch them one at a time.
+FETCH_WORKERS = 8
+
+# Set to True to replace identical files in the stack with hard links to a
+# single copy after installing new products. The digests of the files seen are
+# kept in ``DEDUPLICATE_INDEX`` (relative to the stack), so that only new files
+# are read on later runs. ``DEDUPLICATE_WORKERS`` files are read at once.
+DEDUPLICATE = False
+DEDUPLICATE_INDEX = ".hardlink-index.json.gz"
+DEDUPLICATE_WORKERS = 8
+
+# Tags to keep, or None to keep every tag ever installed. A list of
+# (regular expression, count) tuples: of the tags on the server matching each
+# expression, only the ``count`` most recent are kept, or all of them if
+# ``count`` is None. Tags matching no expression are always kept. Older tags
+# are not installed, and are removed from the stack along with any product
+# versions which no kept tag refers to. For example, to keep the last eight
+# weeklies and all releases:
+#
+#   RETENTION_POLICY = [(r"w_\d{4}_\d\d$", 8), (r"v\d+_\d+", None)]
+RETENTION_POLICY = None
+
+# Number of product versions to delete simultaneously when pruning tags.
+RETENTION_WORKERS = 4
+
+# Number of products to build simultaneously when installing new tags.
+# Products are always installed in dependency order. Values above 1 are only
+# honoured with STAGED_INSTALLS, since EUPS otherwise runs without locks
+# directly against the shared stack.
+INSTALL_WORKERS = 1
+
+# Set to True to build each product in a private staging area within the stack
+# (a separate EUPS_PATH entry layered over the stack) and only publish it into
+# the stack, by renaming, once it has been built successfully. Products which
+# record their absolute installation path in files other than their EUPS
+# declaration (in shared library rpaths, for example) will still refer to the
+# staging area after publication, so this must only be used with products
+# which are relocatable.
+STAGED_INSTALLS = False
+
+# Subdirectory of the stack holding staging areas and the lock which
+# serialises publication from them.
+STAGING_DIR = ".staging"
+
+# When watching the server (``--watch``), the interval between polls is
+# doubled after each failed poll or update, up to ``WATCH_MAX_INTERVAL``
+# seconds, and restored once one succeeds.
+WATCH_MAX_INTERVAL = 3600
+
+# Directory in which responses from ``EUPS_PKGROOT`` are cached between runs,
+# or None to always download everything afresh. Cached copies are revalidated
+# with the server before use.
+HTTP_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                              "shared_stack", "http")
+
+# Cached responses are evicted, least recently used first, when they have not
+# been used for ``HTTP_CACHE_MAX_AGE`` days or when the cache grows beyond
+# ``HTTP_CACHE_MAX_SIZE`` bytes.
+HTTP_CACHE_MAX_AGE = 30
+HTTP_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+# Directory in which downloads and builds used to bootstrap new stacks (the
+# EUPS source and its built installation, and conda packages) are kept for
+# reuse, or None to always fetch and build them afresh. Entries are evicted,
+# least recently used first, when the cache grows beyond
+# ``ARTIFACT_CACHE_MAX_SIZE`` bytes.
+ARTIFACT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                                  "shared_stack", "artifacts")
+ARTIFACT_CACHE_MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+# SHA-256 digest which the EUPS source archive must have, or None to accept
+# whatever is served.
+EUPS_SHA256 = None
+
+# File in which the contents of the tags on ``EUPS_PKGROOT`` are saved between
+# runs, or None to always read every tag afresh. Only tags which are new, or
+# whose entry in the server's tag index has changed, are read again.
+REPOSITORY_SNAPSHOT = os.path.join(os.path.expanduser("~"), ".cache",
+                                   "shared_stack", "repository.json.gz")
+
+# Set to True to download tag lists only when their contents are needed (see
+# LazyRepositoryManager), rather than reading them all at startup. Up to
+# ``LAZY_TAG_CACHE_SIZE`` tag lists are kept in memory at once.
+LAZY_REPOSITORY = False
+LAZY_TAG_CACHE_SIZE = 8
+
+# Number of directories to process simultaneously when preparing newly
+# installed products for use (see StackManager.finalize()), and whether to
+# compile their Python modules to bytecode while doing so.
+FINALIZE_WORKERS = 8
+PRECOMPILE_BYTECODE = True
+
+# Declares a tag on a batch of products in a single Python process, rather
+# than starting ``eups declare`` once per product; the EUPS database is loaded
+# once. It is executed by the interpreter EUPS was installed with; the tag name
+# and global EUPS options (only ``--nolocks`` is understood) are passed as
+# arguments, and whitespace separated product names and versions on stdin, one
+# pair per line.
+DECLARE_TAGS_SCRIPT = dedent("""
+    import sys
+    import eups
+    import eups.hooks
+
+    tagname, options = sys.argv[1], sys.argv[2:]
+    eups.hooks.loadCustomization(path=eups.Eups.setEupsPath())
+    if "--nolocks" in options:
+        eups.hooks.config.site.lockDirectoryBase = None
+    e = eups.Eups()
+    status = 0
+    for line in sys.stdin:
+        product, version = line.split()
+        try:
+            e.assignTag(tagname, product, version)
+        except Exception as exc:
+            sys.stderr.write("Failed to tag %s %s as %s: %s\\n" %
+                             (product, version, tagname, exc))
+            status = 1
+    sys.exit(status)
+""")
+
+
+# Removes tags from, or undeclares, a batch of products in a single Python
+# process. Global EUPS options are passed as arguments; each line of stdin
+# names a product and version to undeclare, or a product, version and tag to
+# remove from it.
+UNDECLARE_SCRIPT = dedent("""
+    import sys
+    import eups.cmd
+
+    options = sys.argv[1:]
+    status = 0
+    for line in sys.stdin:
+        fields = line.split()
+        args = options + ["undeclare"]
+        if len(fields) == 3:
+            args += ["-t", fields[2]]
+        args += fields[:2]
+        if eups.cmd.EupsCmd(args=args, toolname="eups").run():
+            sys.stderr.write("Failed to undeclare %s\\n" % (line.strip(),))
+            status = 1
+    sys.exit(status)
+""")
+
 
 def determine_flavor():
     """
@@ -139,6 +354,855 @@ def determine_flavor():
         raise RuntimeError("Unknown flavor: (%s, %s)" % (uname, machine))
 
 
+class _DirEntry(object):
+    """
+    A minimal substitute for ``os.DirEntry`` where ``os.scandir`` is not
+    available.
+    """
+    __slots__ = ("name", "path")
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            return os.stat(self.path)
+        return os.lstat(self.path)
+
+
+def iter_dir(path):
+    """
+    Return a list of the entries in directory ``path``, as from
+    ``os.scandir()``.
+    """
+    if scandir:
+        return list(scandir(path))
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+def remove_group_write(path):
+    """
+    Remove group write permission from each entry in directory ``path``
+    (symbolic links excepted).
+
+    Returns a list of the subdirectories of ``path`` and whether it contains
+    any Python modules.
+    """
+    subdirs, has_python = [], False
+    for entry in iter_dir(path):
+        if os.path.islink(entry.path):
+            continue
+        mode = os.stat(entry.path).st_mode
+        if mode & stat.S_IWGRP:
+            os.chmod(entry.path, stat.S_IMODE(mode) & ~stat.S_IWGRP)
+        if stat.S_ISDIR(mode):
+            subdirs.append(entry.path)
+        elif entry.name.endswith(".py"):
+            has_python = True
+    return subdirs, has_python
+
+
+def regular_files(path):
+    """
+    Return a list of the subdirectories of directory ``path`` and a list of
+    (path, stat result) tuples for the regular files in it.
+    """
+    subdirs, files = [], []
+    for entry in iter_dir(path):
+        st = os.lstat(entry.path)
+        if stat.S_ISDIR(st.st_mode):
+            subdirs.append(entry.path)
+        elif stat.S_ISREG(st.st_mode):
+            files.append((entry.path, st))
+    return subdirs, files
+
+
+def file_digest(path):
+    """
+    Return the SHA-256 digest of the file at ``path``.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def parallel_walk(paths, func, workers):
+    """
+    Apply ``func`` to every directory in the trees rooted at ``paths``,
+    yielding a (directory, result) tuple for each.
+
+    ``func`` is passed the path to a directory, and must return a tuple of a
+    list of its subdirectories and a result. The trees are walked breadth
+    first, with up to ``workers`` directories at each level processed at the
+    same time.
+    """
+    level = list(paths)
+    while level:
+        next_level = []
+        for path, (subdirs, result) in zip(level, threaded_imap(func, level,
+                                                                workers)):
+            next_level.extend(subdirs)
+            yield path, result
+        level = next_level
+
+
+def threaded_imap(func, iterable, workers):
+    """
+    Apply ``func`` to every item in ``iterable``, yielding the results in
+    order.
+
+    Up to ``workers`` items are processed simultaneously in a pool of threads;
+    if ``workers`` is 1 or less, everything happens in the calling thread.
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap(func, iterable):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class Tracer(object):
+    """
+    Record how long a run spends in each of its phases, in subprocesses and
+    in HTTP requests.
+
+    Recording is disabled until ``enable()`` is called. Events may be
+    recorded from any thread. The results can be written as a JSON summary
+    and as a trace in the Chrome "Trace Event" format, which may be viewed
+    with ``chrome://tracing`` or Perfetto.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._events = []
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def enable(self):
+        self.enabled = True
+        self._start = time.time()
+
+    def record(self, category, name, start, end, group=None, **args):
+        """
+        Record an event in ``category`` which lasted from ``start`` to
+        ``end`` (as returned by ``time.time()``).
+
+        Events are summarised by ``group``, which defaults to ``name``.
+        Additional ``args`` are stored with the event; a ``bytes`` argument is
+        also totalled in the summary.
+        """
+        if not self.enabled:
+            return
+        event = {"name": name, "cat": category, "ph": "X",
+                 "ts": int((start - self._start) * 1e6),
+                 "dur": int((end - start) * 1e6),
+                 "pid": os.getpid(), "tid": threading.current_thread().ident,
+                 "args": dict(args, group=group or name)}
+        with self._lock:
+            self._events.append(event)
+
+    @contextmanager
+    def span(self, category, name, group=None, **args):
+        """
+        Record an event covering the body of a ``with`` statement.
+
+        The value bound by the ``with`` statement is a dictionary to which
+        further arguments for the event may be added.
+        """
+        start = time.time()
+        args = dict(args)
+        try:
+            yield args
+        finally:
+            self.record(category, name, start, time.time(), group, **args)
+
+    def summary(self):
+        """
+        Return a dictionary summarising the events recorded, giving the
+        number of events, the total time spent in them and the total bytes
+        transferred for each category and group.
+        """
+        with self._lock:
+            events = list(self._events)
+        summary = {"wall_time": time.time() - self._start, "categories": {}}
+        for event in events:
+            category = summary["categories"].setdefault(
+                event["cat"], {"count": 0, "seconds": 0.0, "bytes": 0,
+                               "groups": {}})
+            group = category["groups"].setdefault(
+                event["args"]["group"], {"count": 0, "seconds": 0.0,
+                                         "bytes": 0})
+            for totals in (category, group):
+                totals["count"] += 1
+                totals["seconds"] += event["dur"] / 1e6
+                totals["bytes"] += event["args"].get("bytes", 0)
+        return summary
+
+    def write(self, prefix):
+        """
+        Write the summary to ``prefix.json`` and the trace events to
+        ``prefix.trace.json``.
+        """
+        with open(prefix + ".json", "w") as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+        with self._lock:
+            events = list(self._events)
+        with open(prefix + ".trace.json", "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# Tracer shared by everything in this module; see main().
+tracer = Tracer()
+
+
+def describe_command(argv):
+    """
+    Return a short name for the command ``argv`` (a list), consisting of the
+    program name and its first sub-commands, such as "eups distrib install".
+    """
+    words = [os.path.basename(argv[0])]
+    for arg in argv[1:]:
+        if len(words) == 3:
+            break
+        if arg.startswith("-"):
+            continue
+        if not re.match(r"^[\w.]+$", arg):
+            break
+        words.append(arg)
+    return " ".join(words)
+
+
+class FileResponse(object):
+    """
+    An HTTP response whose body is read from a file (e.g. in a cache).
+
+    Provides the subset of the interface of the object returned by
+    ``urlopen()`` which is used in this module; iterating over it yields the
+    lines of the body (as bytes).
+    """
+    def __init__(self, body_file, headers):
+        self._body = body_file
+        self._headers = headers
+
+    def read(self, *args):
+        return self._body.read(*args)
+
+    def readline(self):
+        return self._body.readline()
+
+    def __iter__(self):
+        for line in iter(self.readline, b""):
+            yield line
+        self.close()
+
+    def info(self):
+        """
+        Return a dictionary of response headers, keyed by lower-case name.
+        """
+        return self._headers
+
+    def close(self):
+        self._body.close()
+
+
+class StreamingResponse(FileResponse):
+    """
+    An HTTP response whose body is read incrementally from the server,
+    decompressing it if necessary.
+
+    The connection is handed back to the HTTPClient for re-use once the body
+    has been read in full.
+    """
+    def __init__(self, response, headers, release):
+        """
+        Read the body from ``response``, an ``http.client.HTTPResponse``
+        with the given ``headers``. Once it has been read, or on ``close()``,
+        call ``release(reusable)``, where ``reusable`` indicates whether the
+        connection may be used for another request.
+        """
+        FileResponse.__init__(self, None, headers)
+        self._response = response
+        self._release = release
+        self._buffer = b""
+        self._eof = False
+
+        # Number of bytes received from the server (before decompression).
+        self.bytes_read = 0
+        if headers.get("content-encoding") == "gzip":
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressor = None
+
+    def _fill(self):
+        """
+        Add the next chunk of the body to our buffer.
+        """
+        chunk = self._response.read(65536)
+        self.bytes_read += len(chunk)
+        if self._decompressor:
+            data = self._decompressor.decompress(chunk)
+            if not chunk:
+                data += self._decompressor.flush()
+        else:
+            data = chunk
+        self._buffer += data
+        if not chunk:
+            self._eof = True
+            self._release(not self._response.will_close)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self):
+        while not self._eof and b"\n" not in self._buffer:
+            self._fill()
+        end = self._buffer.find(b"\n") + 1 or len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def close(self):
+        if not self._eof:
+            # The rest of the body is still on its way; abandon the
+            # connection.
+            self._eof = True
+            self._release(False)
+
+
+class HTTPClient(object):
+    """
+    A minimal HTTP client which re-uses connections.
+
+    Connections are kept alive and pooled per host, so that a series of
+    requests to the same server pays for the TCP and TLS handshakes only
+    once. Responses are requested with gzip content encoding and transparently
+    decompressed as they are read. The client may be shared between threads.
+
+    As for ``urlopen()``, proxies are taken from the environment
+    (``http_proxy``, ``https_proxy`` and ``no_proxy``).
+    """
+    def __init__(self, timeout=60, max_redirects=5):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+
+        # Map from (scheme, host, port) to a list of idle connections.
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _proxy(scheme, host):
+        """
+        Return a tuple of the host, port and request headers of the proxy
+        through which to reach ``host`` by ``scheme``, or None if it should
+        be reached directly.
+        """
+        proxy = getproxies().get(scheme)
+        if not proxy or proxy_bypass(host):
+            return None
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        parts = urlsplit(proxy)
+        headers = {}
+        if parts.username:
+            credentials = "%s:%s" % (unquote(parts.username),
+                                     unquote(parts.password or ""))
+            headers["Proxy-Authorization"] = "Basic %s" % (
+                base64.b64encode(credentials.encode('utf-8')).decode('ascii'),)
+        return parts.hostname, parts.port or 80, headers
+
+    def _connect(self, key, proxy=None):
+        """
+        Return a tuple of a connection to ``key``, a (scheme, host, port)
+        tuple, and a flag indicating whether it has been used before.
+
+        New connections are made through ``proxy``, as returned by
+        ``_proxy()``, if given: HTTPS is tunnelled through it, while plain
+        HTTP requests are sent to it directly.
+        """
+        with self._lock:
+            if self._idle.get(key):
+                return self._idle[key].pop(), True
+        scheme, host, port = key
+        if scheme == "https":
+            if proxy:
+                conn = HTTPSConnection(proxy[0], proxy[1],
+                                       timeout=self.timeout)
+                conn.set_tunnel(host, port, headers=proxy[2])
+                return conn, False
+            return HTTPSConnection(host, port, timeout=self.timeout), False
+        if proxy:
+            return HTTPConnection(proxy[0], proxy[1],
+                                  timeout=self.timeout), False
+        return HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _release(self, key, conn, reusable):
+        if not reusable:
+            conn.close()
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def _request(self, method, url, headers):
+        """
+        Perform a single request, returning a StreamingResponse and the
+        response status code and reason.
+
+        The request is recorded by the tracer when the response body has been
+        read.
+        """
+        start = time.time()
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        proxy = self._proxy(parts.scheme, parts.hostname)
+        if proxy and parts.scheme == "http":
+            # The proxy forwards the request, so needs the whole URL.
+            path = "%s://%s%s" % (parts.scheme, parts.netloc, path)
+            headers = dict(headers, **proxy[2])
+        while True:
+            conn, reused = self._connect(key, proxy)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (HTTPException, socket.error):
+                conn.close()
+                # The server may have closed an idle connection; retry once
+                # on a fresh one.
+                if reused:
+                    continue
+                raise
+            break
+
+        response_headers = dict((name.lower(), value)
+                                for name, value in response.getheaders())
+
+        def release(reusable):
+            self._release(key, conn, reusable)
+            tracer.record("http", url, start, time.time(),
+                          group=parts.hostname, method=method,
+                          status=response.status,
+                          bytes=streaming_response.bytes_read)
+
+        streaming_response = StreamingResponse(response, response_headers,
+                                               release)
+        return streaming_response, response.status, response.reason
+
+    def urlopen(self, url, headers=None, method="GET"):
+        """
+        Retrieve ``url``, following redirects, and return a
+        StreamingResponse.
+
+        ``headers`` are added to the request. As for ``urlopen()``, an
+        HTTPError is raised if the final status is not a success.
+        """
+        request_headers = {"Accept-Encoding": "gzip"}
+        if headers:
+            request_headers.update(headers)
+        for _ in range(self.max_redirects + 1):
+            response, status, reason = self._request(method, url,
+                                                     request_headers)
+            if status in (301, 302, 303, 307, 308):
+                response.read()
+                url = urljoin(url, response.info()["location"])
+                continue
+            break
+        if status >= 300:
+            raise HTTPError(url, status, reason, response.info(),
+                            io.BytesIO(response.read()))
+        if method == "HEAD":
+            # There is no body; free up the connection.
+            response.read()
+        return response
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            for connections in self._idle.values():
+                for conn in connections:
+                    conn.close()
+            self._idle = {}
+
+
+# Client shared by all pkgroot traffic in this module.
+http_client = HTTPClient()
+
+
+class HTTPCache(object):
+    """
+    A persistent, on-disk cache of HTTP responses, keyed by URL.
+
+    Cached responses are revalidated with the server on every use by means of
+    a conditional request; the server is only asked to send the body again if
+    it has changed.
+    """
+    def __init__(self, cache_dir, max_age=HTTP_CACHE_MAX_AGE,
+                 max_size=HTTP_CACHE_MAX_SIZE, client=http_client):
+        """
+        Store cached responses in ``cache_dir``, which is created if it does
+        not already exist.
+
+        ``max_age`` (in days) and ``max_size`` (in bytes) bound the contents
+        of the cache when ``prune()`` is called; either may be None.
+
+        Requests to the server are made through ``client``, an HTTPClient.
+        """
+        self.cache_dir = cache_dir
+        self.client = client
+        self.max_age = max_age
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _paths(self, url):
+        """
+        Return the paths to the body and metadata files for ``url``.
+        """
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return (os.path.join(self.cache_dir, key + ".body"),
+                os.path.join(self.cache_dir, key + ".json"))
+
+    def _load(self, url):
+        """
+        Return a tuple of an open file containing the cached body for ``url``
+        and a dictionary of its headers, or None.
+        """
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                headers = json.load(f)
+            return open(body_path, "rb"), headers
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _store(self, url, response, headers):
+        """
+        Atomically write the body of ``response`` and ``headers`` to the
+        cache.
+
+        The body is copied to disk as it arrives. The metadata is written
+        last, so that a partially-written entry is never used.
+        """
+        body_path, meta_path = self._paths(url)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(response, f)
+        os.rename(tmp_path, body_path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(headers, f)
+        os.rename(tmp_path, meta_path)
+
+    def urlopen(self, url):
+        """
+        Retrieve ``url``, using the cached copy if the server reports that it
+        has not been modified.
+
+        Returns a FileResponse, which reads the body from the cache.
+        """
+        cached = self._load(url)
+        request_headers = {}
+        if cached:
+            body_file, headers = cached
+            if headers.get("last-modified"):
+                request_headers["If-Modified-Since"] = headers["last-modified"]
+            if headers.get("etag"):
+                request_headers["If-None-Match"] = headers["etag"]
+        try:
+            u = self.client.urlopen(url, headers=request_headers)
+        except HTTPError as e:
+            if e.code != 304 or not cached:
+                raise
+            # Not modified; touch the metadata to record that it was used.
+            os.utime(self._paths(url)[1], None)
+            return FileResponse(body_file, headers)
+        if cached:
+            body_file.close()
+        headers = {"url": url}
+        for name in ("last-modified", "etag"):
+            if u.info().get(name):
+                headers[name] = u.info().get(name)
+        self._store(url, u, headers)
+        return FileResponse(open(self._paths(url)[0], "rb"), headers)
+
+    def prune(self):
+        """
+        Evict entries which are older than ``max_age`` days, then the least
+        recently used entries until the cache is smaller than ``max_size``.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            meta_path = os.path.join(self.cache_dir, name)
+            body_path = meta_path[:-5] + ".body"
+            try:
+                size = (os.path.getsize(meta_path) +
+                        os.path.getsize(body_path))
+                entries.append((os.path.getmtime(meta_path), size,
+                                meta_path, body_path))
+            except OSError:
+                continue
+        entries.sort(reverse=True)
+
+        now = time.time()
+        total_size = 0
+        for last_used, size, meta_path, body_path in entries:
+            total_size += size
+            if ((self.max_age is not None and
+                 now - last_used > self.max_age * 86400) or
+                    (self.max_size is not None and
+                     total_size > self.max_size)):
+                for path in (meta_path, body_path):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+
+
+class ArtifactCache(object):
+    """
+    A persistent, content-addressed store of downloads and build products.
+
+    Each artifact is stored once, named by its SHA-256 digest, and is
+    verified against it whenever it is used. Artifacts are found by URL (for
+    downloads) or by an arbitrary key (for directory trees, which are stored
+    as gzipped tarballs); those indices are separate from the objects, so
+    identical content is only stored once.
+    """
+    def __init__(self, cache_dir, max_size=ARTIFACT_CACHE_MAX_SIZE,
+                 client=http_client):
+        """
+        Store artifacts in ``cache_dir``, which is created if it does not
+        already exist.
+
+        ``max_size`` (in bytes) bounds the objects stored when ``prune()`` is
+        called; it may be None.
+
+        Downloads are made through ``client``, an HTTPClient.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.client = client
+        self._objects_dir = os.path.join(cache_dir, "objects")
+        self._index_dir = os.path.join(cache_dir, "index")
+        # Shared with conda, which manages (and verifies) its own packages.
+        self.conda_pkgs_dir = os.path.join(cache_dir, "conda-pkgs")
+        for path in (self._objects_dir, self._index_dir, self.conda_pkgs_dir):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _index_path(self, kind, key):
+        """
+        Return the path to the index entry for ``key`` (a string) of kind
+        "url" or "tree".
+        """
+        return os.path.join(self._index_dir, "%s-%s.json" %
+                            (kind, hashlib.sha1(key.encode('utf-8'))
+                             .hexdigest()))
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects_dir, digest)
+
+    def _lookup(self, kind, key):
+        """
+        Return the path to the verified object stored for ``key``, or None.
+
+        Objects which fail verification are discarded.
+        """
+        try:
+            with open(self._index_path(kind, key)) as f:
+                digest = json.load(f)["sha256"]
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            return None
+        if file_digest(path) != digest:
+            print("Discarding corrupt cached artifact for %s" % (key,))
+            os.unlink(path)
+            return None
+        # Record the use, for eviction.
+        os.utime(path, None)
+        return path
+
+    def _add(self, kind, key, write):
+        """
+        Store the output of ``write``, a function which is passed a file
+        object to write to, as the object for ``key``.
+
+        Returns the path to the object and its digest.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self._objects_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            digest = file_digest(tmp_path)
+            os.rename(tmp_path, self._object_path(digest))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        fd, tmp_path = tempfile.mkstemp(dir=self._index_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump({kind: key, "sha256": digest}, f)
+        os.rename(tmp_path, self._index_path(kind, key))
+        return self._object_path(digest), digest
+
+    def fetch(self, url, sha256=None):
+        """
+        Return the path to a copy of ``url`` in the cache, downloading it if
+        necessary.
+
+        If ``sha256`` is given, the content must have that digest; a
+        ValueError is raised if what is downloaded does not.
+        """
+        path = self._lookup("url", url)
+        if path and sha256 and os.path.basename(path) != sha256:
+            path = None
+        if not path:
+            with tracer.span("artifact", url):
+                path, digest = self._add(
+                    "url", url, lambda f: shutil.copyfileobj(
+                        self.client.urlopen(url), f))
+            if sha256 and digest != sha256:
+                raise ValueError("%s has SHA-256 %s, not %s" %
+                                 (url, digest, sha256))
+        return path
+
+    def restore_tree(self, key, dest_dir):
+        """
+        Extract the directory tree stored for ``key`` into ``dest_dir``.
+
+        Returns True if it was found, False otherwise.
+        """
+        path = self._lookup("tree", key)
+        if not path:
+            return False
+        with tarfile.open(path, "r:gz") as tf:
+            tf.extractall(dest_dir)
+        return True
+
+    def store_tree(self, key, src_dir, arcname):
+        """
+        Store the directory tree at ``src_dir`` for ``key``; it will be
+        restored under the name ``arcname``.
+        """
+        def write(f):
+            with tarfile.open(fileobj=f, mode="w:gz") as tf:
+                tf.add(src_dir, arcname=arcname)
+        self._add("tree", key, write)
+
+    def prune(self):
+        """
+        Evict the least recently used objects until the objects stored are
+        smaller than ``max_size``.
+
+        Index entries referring to evicted objects are ignored on lookup.
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        for entry in iter_dir(self._objects_dir):
+            try:
+                st = os.stat(entry.path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort(reverse=True)
+        total_size = 0
+        for last_used, size, path in entries:
+            total_size += size
+            if total_size > self.max_size:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+
+class FileHashIndex(object):
+    """
+    A persistent record of the digests of files in a directory tree.
+
+    Entries are keyed by path relative to the tree, and record the file's
+    size, modification time, device, inode, mode, owner and group alongside
+    its digest (which may be None if it has not been needed yet). An entry is
+    only trusted while the file's size, modification time and inode are
+    unchanged.
+    """
+    FORMAT = 1
+
+    def __init__(self, path):
+        """
+        Load the index stored at ``path``, if any.
+        """
+        self.path = path
+        self.entries = {}
+        try:
+            with gzip.open(path, "rb") as f:
+                index = json.loads(f.read().decode('utf-8'))
+            if index["format"] == self.FORMAT:
+                self.entries = index["entries"]
+        except (IOError, OSError, EOFError, KeyError, TypeError, ValueError,
+                zlib.error):
+            pass
+
+    @staticmethod
+    def entry(st, digest=None):
+        """
+        Return an entry for a file with stat result ``st``.
+        """
+        return [st.st_size, st.st_mtime, st.st_dev, st.st_ino,
+                stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid, digest]
+
+    @staticmethod
+    def matches(entry, st):
+        """
+        Return True if ``entry`` still describes the file with stat result
+        ``st``.
+        """
+        return entry[:4] == [st.st_size, st.st_mtime, st.st_dev, st.st_ino]
+
+    def save(self):
+        """
+        Atomically write the index back to its path.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, "wb") as raw, \
+                    gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                f.write(json.dumps({"format": self.FORMAT,
+                                    "entries": self.entries},
+                                   separators=(",", ":")).encode('utf-8'))
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
 class Product(object):
     """
     Information about a particular EUPS product.
@@ -146,6 +1210,8 @@ class Product(object):
     This includes the the product name, the available versions and their
     associated tags (if any).
     """
+    __slots__ = ("name", "_versions", "_tags")
+
     def __init__(self, name):
         self.name = name
 
@@ -154,12 +1220,16 @@ class Product(object):
         # versions which have no tags and versions which do not exist.
         self._versions = {}
 
+        # All tags applied to any version of the product.
+        self._tags = set()
+
     def add_version(self, version):
         if version not in self._versions:
             self._versions[version] = set()
 
     def add_tag(self, version, tag):
         self._versions[version].add(tag)
+        self._tags.add(tag)
 
     def versions(self, tag=None):
         """
@@ -177,7 +1247,7 @@ class Product(object):
         ``None``, return only those tags which refer to ``version``.
         """
         if version is None:
-            return set.union(*self._versions.values())
+            return set(self._tags)
         else:
             return self._versions[version]
 
@@ -185,10 +1255,20 @@ class Product(object):
 class ProductTracker(object):
     """
     Track a collection of Products.
+
+    In addition to the Products themselves, we maintain an index from each tag
+    to the versions of each product which carry it, so that queries by tag do
+    not need to visit every product.
     """
+    __slots__ = ("_products", "_tag_index")
+
     def __init__(self):
         self._products = {}
 
+        # Map from tag to a map from product name to the list of versions of
+        # that product carrying the tag.
+        self._tag_index = {}
+
     def tags_for_product(self, product_name):
         """
         Return the set of all tags which contain a product
@@ -205,72 +1285,1037 @@ class ProductTracker(object):
         ``tag``.
         """
         results = []
-        for product in self._products.values():
-            versions = product.versions(tag=tag)
+        for product_name, versions in self._tag_index.get(tag, {}).items():
             for version in versions:
-                results.append((product.name, version))
+                results.append((product_name, version))
         return results
 
+    def versions_for_tag(self, product_name, tag):
+        """
+        Return a list of the versions of ``product_name`` which are tagged
+        with ``tag``.
+        """
+        return list(self._tag_index.get(tag, {}).get(product_name, []))
+
     def current(self, product_name):
         """
         Return the version of product_name which is tagged "current", or None.
         """
         if product_name in self._products:
-            return self._products[product_name].versions("current")[0]
+            return self.versions_for_tag(product_name, "current")[0]
+
+    def tags_for_version(self, product_name, version):
+        """
+        Return the set of tags applied to ``version`` of ``product_name``.
+        """
+        try:
+            return set(self._products[product_name].tags(version))
+        except KeyError:
+            return set()
+
+    def has_version(self, product_name, version):
+        """
+        Return True if we have the given version of product name.
+        """
+        return (product_name in self._products and
+                version in self._products[product_name].versions())
+
+    def remove(self, product_name):
+        """
+        Stop tracking all versions of ``product_name``.
+        """
+        product = self._products.pop(product_name, None)
+        if product is None:
+            return
+        for tag in product.tags():
+            del self._tag_index[tag][product_name]
+            if not self._tag_index[tag]:
+                del self._tag_index[tag]
+
+    def insert(self, product, version, tag=None):
+        """
+        Add (product, version, tag) to the list of products being tracked.
+        """
+        if product not in self._products:
+            self._products[product] = Product(product)
+        self._products[product].add_version(version)
+        if tag and tag not in self._products[product].tags(version):
+            self._products[product].add_tag(version, tag)
+            product_versions = self._tag_index.setdefault(tag, {})
+            product_versions.setdefault(product, []).append(version)
+
+
+def intern_string(string):
+    """
+    Return the interned copy of ``string``.
+
+    Python 2's ``intern()`` only accepts byte strings; other strings (such as
+    the unicode decoded from the server) are returned as they are.
+    """
+    if isinstance(string, str):
+        return intern(string)
+    return string
+
+
+class StringTable(object):
+    """
+    Map strings to small integer ids and back.
+
+    Each distinct string is stored (interned) only once.
+    """
+    __slots__ = ("_ids", "_strings")
+
+    def __init__(self):
+        self._ids = {}
+        self._strings = []
+
+    def __len__(self):
+        return len(self._strings)
+
+    def add(self, string):
+        """
+        Return the id of ``string``, allocating one if necessary.
+        """
+        try:
+            return self._ids[string]
+        except KeyError:
+            string = intern_string(string)
+            self._ids[string] = len(self._strings)
+            self._strings.append(string)
+            return self._ids[string]
+
+    def id(self, string):
+        """
+        Return the id of ``string``, or None if it has not been added.
+        """
+        return self._ids.get(string)
+
+    def string(self, string_id):
+        return self._strings[string_id]
+
+
+def _bits(bitset):
+    """
+    Yield the indices of the bits which are set in the integer ``bitset``.
+    """
+    while bitset:
+        lowest = bitset & -bitset
+        yield lowest.bit_length() - 1
+        bitset ^= lowest
+
+
+class CompactProductTracker(object):
+    """
+    A memory-efficient alternative to ProductTracker with the same interface.
+
+    Intended for trackers holding very many (product, version, tag) entries,
+    such as that of a RepositoryManager. Rather than storing a Product object
+    with per-version sets of strings, every product name, version and tag is
+    interned once and referred to by an integer id:
+
+    - Each distinct (product, version) pair is assigned an id, and its
+      product and version ids are stored in parallel arrays;
+    - The tags carried by each (product, version) pair, and by any version of
+      each product, are recorded as bitsets indexed by tag id;
+    - The members of each tag are stored as an array of (product, version)
+      ids.
+    """
+    __slots__ = ("_strings", "_tags", "_pv_ids", "_pv_product", "_pv_version",
+                 "_pv_tags", "_product_versions", "_product_tags",
+                 "_tag_members")
+
+    def __init__(self):
+        # Product names and versions.
+        self._strings = StringTable()
+        # Tags; a tag's id is also its position in the bitsets below.
+        self._tags = StringTable()
+
+        # Map from (product_id << 32 | version_id) to (product, version) id.
+        self._pv_ids = {}
+        # Product id, version id and tag bitset for each (product, version).
+        self._pv_product = array('i')
+        self._pv_version = array('i')
+        self._pv_tags = []
+
+        # Map from product id to an array of its (product, version) ids, and
+        # to a bitset of all tags applied to any of its versions.
+        self._product_versions = {}
+        self._product_tags = {}
+
+        # For each tag id, an array of the (product, version) ids it carries.
+        self._tag_members = []
+
+    def _pv_id(self, product_name, version):
+        """
+        Return the id of the (product_name, version) pair, or None.
+        """
+        product_id = self._strings.id(product_name)
+        version_id = self._strings.id(version)
+        if product_id is None or version_id is None:
+            return None
+        return self._pv_ids.get(product_id << 32 | version_id)
+
+    def tags_for_product(self, product_name):
+        """
+        Return the set of all tags which contain a product
+        named ``product_name``.
+        """
+        product_id = self._strings.id(product_name)
+        return set(self._tags.string(tag_id) for tag_id in
+                   _bits(self._product_tags.get(product_id, 0)))
+
+    def products_for_tag(self, tag):
+        """
+        Return a list of (product_name, version) tuples which are tagged with
+        ``tag``.
+        """
+        tag_id = self._tags.id(tag)
+        if tag_id is None:
+            return []
+        string = self._strings.string
+        return [(string(self._pv_product[pv_id]),
+                 string(self._pv_version[pv_id]))
+                for pv_id in self._tag_members[tag_id]]
+
+    def versions_for_tag(self, product_name, tag):
+        """
+        Return a list of the versions of ``product_name`` which are tagged
+        with ``tag``.
+        """
+        product_id = self._strings.id(product_name)
+        tag_id = self._tags.id(tag)
+        if product_id is None or tag_id is None:
+            return []
+        return [self._strings.string(self._pv_version[pv_id])
+                for pv_id in self._product_versions[product_id]
+                if self._pv_tags[pv_id] >> tag_id & 1]
+
+    def current(self, product_name):
+        """
+        Return the version of product_name which is tagged "current", or None.
+        """
+        if self._strings.id(product_name) in self._product_versions:
+            return self.versions_for_tag(product_name, "current")[0]
+
+    def tags_for_version(self, product_name, version):
+        """
+        Return the set of tags applied to ``version`` of ``product_name``.
+        """
+        pv_id = self._pv_id(product_name, version)
+        if pv_id is None:
+            return set()
+        return set(self._tags.string(tag_id)
+                   for tag_id in _bits(self._pv_tags[pv_id]))
 
     def has_version(self, product_name, version):
         """
-        Return True if we have the given version of product name.
+        Return True if we have the given version of product name.
+        """
+        return self._pv_id(product_name, version) is not None
+
+    def insert(self, product, version, tag=None):
+        """
+        Add (product, version, tag) to the list of products being tracked.
+        """
+        product_id = self._strings.add(product)
+        version_id = self._strings.add(version)
+        key = product_id << 32 | version_id
+        pv_id = self._pv_ids.get(key)
+        if pv_id is None:
+            pv_id = self._pv_ids[key] = len(self._pv_tags)
+            self._pv_product.append(product_id)
+            self._pv_version.append(version_id)
+            self._pv_tags.append(0)
+            self._product_versions.setdefault(product_id,
+                                              array('i')).append(pv_id)
+            self._product_tags.setdefault(product_id, 0)
+        if tag:
+            tag_id = self._tags.add(tag)
+            if tag_id == len(self._tag_members):
+                self._tag_members.append(array('i'))
+            if not self._pv_tags[pv_id] >> tag_id & 1:
+                self._pv_tags[pv_id] |= 1 << tag_id
+                self._product_tags[product_id] |= 1 << tag_id
+                self._tag_members[tag_id].append(pv_id)
+
+
+class TagIndexParser(HTMLParser):
+    """
+    Extract the links from the ``<pre>`` section of a directory index, such
+    as that served for ``EUPS_PKGROOT/tags``.
+
+    After the index has been fed to the parser and it has been closed,
+    ``links`` contains an (href, text, description) tuple for each link,
+    where description is the text following the link on the same line
+    (typically its modification date and size).
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+        self._in_pre = False
+        self._in_link = False
+        # Link currently being parsed: [href, text parts, description parts].
+        self._link = None
+
+    def _finish_link(self):
+        if self._link is not None:
+            href, text, description = self._link
+            self.links.append((href, "".join(text).strip(),
+                               "".join(description).split("\n")[0].strip()))
+            self._link = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "pre":
+            self._in_pre = True
+        elif tag == "a" and self._in_pre:
+            self._finish_link()
+            self._link = [dict(attrs).get("href"), [], []]
+            self._in_link = True
+
+    def handle_endtag(self, tag):
+        if tag == "a":
+            self._in_link = False
+        elif tag == "pre":
+            self._finish_link()
+            self._in_pre = False
+
+    def handle_data(self, data):
+        if self._link is not None:
+            self._link[1 if self._in_link else 2].append(data)
+
+    def close(self):
+        HTMLParser.close(self)
+        self._finish_link()
+
+
+def parse_tag_index(lines):
+    """
+    Return the links in a directory index, as recorded by TagIndexParser.
+
+    ``lines`` is an iterable of (bytes) lines, which are parsed as they
+    arrive.
+    """
+    parser = TagIndexParser()
+    for line in lines:
+        parser.feed(line.decode('utf-8'))
+    parser.close()
+    return parser.links
+
+
+def parse_tag_list(lines, tag):
+    """
+    Yield a (product_name, version) tuple for each product in a tag list.
+
+    ``lines`` is an iterable of the (bytes) lines of the list for ``tag``,
+    which are parsed as they arrive.
+    """
+    header = "EUPS distribution %s version list" % (tag,)
+    for line in lines:
+        line = line.decode('utf-8').strip()
+        if not line or line[0] == "#" or header in line:
+            continue
+        product, flavor, version = line.split()
+        yield product, version
+
+
+class RepositoryManager(object):
+    """
+    Provide access to a ProductTracker built on a remote repository.
+    """
+    # Version of the snapshot file format; snapshots in any other format are
+    # ignored.
+    SNAPSHOT_FORMAT = 1
+    SNAPSHOT_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+    def __init__(self, pkgroot=EUPS_PKGROOT, pattern=r".*",
+                 workers=FETCH_WORKERS, cache=None, snapshot=None):
+        """
+        Only tags which match regular expression ``pattern`` are recorded.
+        More tags -> slower loading.
+
+        Up to ``workers`` tag lists are downloaded at the same time. The
+        results are always recorded in the order in which the tags appear on
+        the server, so the outcome does not depend on ``workers``.
+
+        If ``cache`` (an HTTPCache) is supplied, all downloads go through it.
+
+        If ``snapshot`` (a path) is supplied, the tags recorded there by a
+        previous RepositoryManager are reused, provided their descriptions
+        (modification date and size) in the server's tag index are unchanged,
+        and the snapshot is updated afterwards.
+        """
+        self.pkgroot = pkgroot
+        self._pattern = pattern
+        self._workers = workers
+        self._cache = cache
+        self._snapshot = snapshot
+
+        # Map from (product_name, version) to the contents of its manifest.
+        self._manifests = {}
+
+        # Validators (Last-Modified and ETag) of the last tag index retrieved
+        # directly from the server, used to make conditional requests for it.
+        self._index_validators = {}
+
+        saved_tags = self._read_snapshot(snapshot) if snapshot else {}
+        tag_files, self._index_validators = self._read_index()
+        self._load(tag_files, saved_tags)
+
+    def _read_index(self):
+        """
+        Return a list of (tag, href, description) tuples for each tag in the
+        server's tag index which matches our pattern, in index order, or None
+        if the index has not been modified since we last read it.
+
+        Also returns the validators with which to make the next conditional
+        request for the index. They should only replace ours once the tags
+        have been loaded; otherwise, the index would not be read again.
+        """
+        url = self.pkgroot + "/tags"
+        validators = {}
+        if self._cache:
+            u = self._cache.urlopen(url)
+        else:
+            headers = {}
+            if "last-modified" in self._index_validators:
+                headers["If-Modified-Since"] = \
+                    self._index_validators["last-modified"]
+            if "etag" in self._index_validators:
+                headers["If-None-Match"] = self._index_validators["etag"]
+            try:
+                u = http_client.urlopen(url, headers=headers)
+            except HTTPError as e:
+                if e.code == 304:
+                    return None, self._index_validators
+                raise
+            validators = dict(
+                (name, value) for name, value in u.info().items()
+                if name in ("last-modified", "etag"))
+        return ([(text[:-5], href, description) for href, text, description
+                 in parse_tag_index(u)
+                 if text[-5:] == ".list" and re.match(self._pattern, text)],
+                validators)
+
+    def _load(self, tag_files, saved_tags):
+        """
+        Build our tracker from the tags described by ``tag_files``, as
+        returned by ``_read_index()``.
+
+        ``saved_tags`` is a dictionary, as returned by ``_read_snapshot()``,
+        of tags whose contents are already known; they are only downloaded
+        if their description has changed. Returns a list of the tags which
+        were downloaded.
+
+        Nothing is replaced until every tag has been loaded, so that if any
+        cannot be, our record is left as it was.
+        """
+        product_tracker = CompactProductTracker()
+        tag_dates = {}
+
+        # Lists fetched in parallel must be read in full by the worker
+        # threads; otherwise, they are parsed into the tracker as they
+        # arrive.
+        fetch = self._fetch_tag if self._workers > 1 else self._open_tag
+
+        # Tags which were not available from saved_tags.
+        fetched = []
+
+        def load(tag_file):
+            tag, href, description = tag_file
+            if tag in saved_tags and saved_tags[tag][0] == description:
+                return (tag,) + saved_tags[tag][1:]
+            fetched.append(tag)
+            return fetch((tag, href))
+
+        for tag, tag_date, entries in threaded_imap(load, tag_files,
+                                                    self._workers):
+            tag_dates[tag] = tag_date
+            for product, version in entries:
+                product_tracker.insert(product, version, tag)
+
+        self._product_tracker = product_tracker
+        self.tag_dates = tag_dates
+        # (tag, href, description) for each tag recorded, in index order.
+        self._tag_files = tag_files
+
+        if self._snapshot and (fetched or
+                               set(saved_tags) != set(self.tag_dates)):
+            self.write_snapshot(self._snapshot)
+        return fetched
+
+    def refresh(self):
+        """
+        Bring our record of the server up to date.
+
+        The tag index is requested again, conditionally if possible; tags
+        which are new, or whose description in the index has changed, are
+        downloaded. Returns a list of those tags, which is empty if nothing
+        has changed.
+        """
+        tag_files, validators = self._read_index()
+        if tag_files is None or tag_files == self._tag_files:
+            self._index_validators = validators
+            return []
+        saved_tags = dict(
+            (tag, (description, self.tag_dates[tag],
+                   self.products_for_tag(tag)))
+            for tag, href, description in self._tag_files)
+        fetched = self._load(tag_files, saved_tags)
+        self._index_validators = validators
+        return fetched
+
+    def _read_snapshot(self, path):
+        """
+        Return a dictionary mapping each tag recorded in the snapshot at
+        ``path`` to a tuple of its index description, date and contents (a
+        tuple of (product_name, version) tuples).
+
+        Returns an empty dictionary if there is no usable snapshot of this
+        repository at ``path``.
+        """
+        try:
+            with gzip.open(path, "rb") as f:
+                snapshot = json.loads(f.read().decode('utf-8'))
+            if (snapshot["format"] != self.SNAPSHOT_FORMAT or
+                    snapshot["pkgroot"] != self.pkgroot):
+                return {}
+            strings = snapshot["strings"]
+            saved_tags = {}
+            for tag, description, tag_date, ids in snapshot["tags"]:
+                saved_tags[tag] = (
+                    description,
+                    datetime.strptime(tag_date, self.SNAPSHOT_DATE_FORMAT),
+                    tuple((strings[ids[i]], strings[ids[i + 1]])
+                          for i in range(0, len(ids), 2)))
+            return saved_tags
+        except (IOError, OSError, EOFError, KeyError, IndexError, TypeError,
+                ValueError, zlib.error) as e:
+            if os.path.exists(path):
+                print("Ignoring unreadable snapshot %s (%s)" % (path, e))
+            return {}
+
+    def write_snapshot(self, path):
+        """
+        Save the tags we have loaded to ``path``, from which they can be
+        reloaded by passing ``snapshot=path`` to a new RepositoryManager.
+
+        The snapshot is gzipped JSON, recording each distinct product name
+        and version once; each tag's contents are stored as a flat list of
+        indices into that table.
+        """
+        strings = StringTable()
+        tags = []
+        for tag, href, description in self._tag_files:
+            ids = []
+            for product, version in self.products_for_tag(tag):
+                ids.append(strings.add(product))
+                ids.append(strings.add(version))
+            tags.append([tag, description,
+                         self.tag_dates[tag].strftime(
+                             self.SNAPSHOT_DATE_FORMAT),
+                         ids])
+        snapshot = {"format": self.SNAPSHOT_FORMAT,
+                    "pkgroot": self.pkgroot,
+                    "strings": [strings.string(i)
+                                for i in range(len(strings))],
+                    "tags": tags}
+
+        # Write to a temporary file which is renamed into place, so that
+        # readers never see a partial snapshot.
+        snapshot_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir)
+        try:
+            with os.fdopen(fd, "wb") as raw, \
+                    gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                f.write(json.dumps(snapshot, separators=(",", ":"))
+                        .encode('utf-8'))
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _urlopen(self, url):
+        """
+        Retrieve ``url``, through the cache if we have one.
+        """
+        if self._cache:
+            return self._cache.urlopen(url)
+        return http_client.urlopen(url)
+
+    def _open_tag(self, tag_file):
+        """
+        Start retrieving the tag list described by ``tag_file``, a
+        (tag, href) tuple.
+
+        Returns a tuple of the tag name, its modification date on the server
+        and an iterator over the (product_name, version) tuples it contains,
+        which parses the list as it is read.
+        """
+        tag, href = tag_file
+        u = self._urlopen(self.pkgroot + '/tags/' + href)
+        tag_date = datetime.strptime(u.info()['last-modified'],
+                                     "%a, %d %b %Y %H:%M:%S %Z")
+        return tag, tag_date, parse_tag_list(u, tag)
+
+    def _fetch_tag(self, tag_file):
+        """
+        As ``_open_tag()``, but read the whole list before returning, so
+        that the iterator is replaced by a list.
+        """
+        tag, tag_date, entries = self._open_tag(tag_file)
+        return tag, tag_date, list(entries)
+
+    def manifest(self, product_name, version):
+        """
+        Return the contents of the manifest for ``version`` of
+        ``product_name`` on the server.
+
+        The manifest lists the product and everything it depends on, in
+        dependency order, as (product_name, version, install_id) tuples.
+        """
+        key = (product_name, version)
+        if key not in self._manifests:
+            u = self._urlopen("%s/manifests/%s-%s.manifest" %
+                              (self.pkgroot, product_name, version))
+            entries = []
+            for line in u:
+                line = line.decode('utf-8').strip()
+                if (not line or line[0] == "#" or
+                        line.startswith("EUPS distribution manifest")):
+                    continue
+                fields = line.split()
+                entries.append((fields[0], fields[2],
+                                fields[5] if len(fields) > 5 else ""))
+            self._manifests[key] = entries
+        return self._manifests[key]
+
+    def dependencies(self, product_name, version):
+        """
+        Return a list of the (product_name, version) tuples on which
+        ``version`` of ``product_name`` depends, directly or indirectly,
+        according to its manifest on the server.
+        """
+        return [(dependency, dependency_version)
+                for dependency, dependency_version, install_id
+                in self.manifest(product_name, version)
+                if (dependency, dependency_version) != (product_name, version)]
+
+    def tag_closure(self, tag, product_names=PRODUCTS):
+        """
+        Return a list of the (product_name, version) tuples which installing
+        each of ``product_names`` from ``tag`` would install: the version of
+        the product in the tag and everything it depends on, in dependency
+        order. Products which are not in the tag are ignored.
+        """
+        versions = dict(self.products_for_tag(tag))
+        pairs, seen = [], set()
+        for product_name in product_names:
+            if product_name not in versions:
+                continue
+            for name, version, install_id in self.manifest(
+                    product_name, versions[product_name]):
+                if (name, version) not in seen:
+                    seen.add((name, version))
+                    pairs.append((name, version))
+        return pairs
+
+    def distribution_size(self, product_name, version):
+        """
+        Return the size in bytes of the package from which ``version`` of
+        ``product_name`` is installed, or None if it cannot be determined.
+        """
+        try:
+            manifest = self.manifest(product_name, version)
+        except (HTTPError, IOError, IndexError):
+            return None
+        for name, manifest_version, install_id in manifest:
+            if ((name, manifest_version) != (product_name, version) or
+                    not install_id.startswith("eupspkg:")):
+                continue
+            try:
+                u = http_client.urlopen("%s/products/%s" %
+                                        (self.pkgroot, install_id[8:]),
+                                        method="HEAD")
+                return int(u.info()["content-length"])
+            except (HTTPError, KeyError, ValueError):
+                return None
+
+    def tags_for_product(self, product_name):
+        return self._product_tracker.tags_for_product(product_name)
+
+    def products_for_tag(self, tag):
+        return self._product_tracker.products_for_tag(tag)
+
+
+class LazyRepositoryManager(RepositoryManager):
+    """
+    A RepositoryManager which reads only the server's tag index at startup.
+
+    Each tag list is downloaded and parsed the first time its contents are
+    required; a limited number of parsed lists are kept, least recently used
+    first out. Tag dates are taken from the index.
+
+    Products in ``assumed_products`` are taken to be in every tag, so that
+    ``tags_for_product()`` can be answered for them from the tag names alone;
+    callers must check the contents of any tag they go on to use (as
+    ``update_stack()`` does). For any other product, every tag is read.
+    """
+    # Format of the modification date at the start of a tag's description in
+    # the index, as written by Apache.
+    INDEX_DATE_FORMAT = "%d-%b-%Y %H:%M"
+
+    def __init__(self, pkgroot=EUPS_PKGROOT, pattern=r".*",
+                 workers=FETCH_WORKERS, cache=None,
+                 max_tags=LAZY_TAG_CACHE_SIZE, assumed_products=PRODUCTS):
+        """
+        Keep the contents of up to ``max_tags`` tags in memory.
+
+        Other arguments are as for RepositoryManager, except that no
+        snapshot is loaded: little is read at startup in any case. (A
+        snapshot may still be written with ``write_snapshot()``, which reads
+        every tag.)
+        """
+        self._max_tags = max_tags
+        self._assumed_products = set(assumed_products)
+        # Map from tag to the description and href of its list in the index.
+        self._tag_handles = {}
+        # Map from tag to a tuple of its (product_name, version) tuples, in
+        # order of use.
+        self._parsed_tags = OrderedDict()
+        self._parsed_lock = threading.Lock()
+        RepositoryManager.__init__(self, pkgroot, pattern, workers, cache)
+
+    def _load(self, tag_files, saved_tags):
+        """
+        Record the tags described by ``tag_files`` without reading them,
+        discarding the contents of any which have changed.
+
+        Returns a list of the tags which are new or have changed.
+        """
+        changed = []
+        tag_handles = {}
+        tag_dates = {}
+        for tag, href, description in tag_files:
+            tag_handles[tag] = (description, href)
+            if self._tag_handles.get(tag) == (description, href):
+                tag_dates[tag] = self.tag_dates[tag]
+                continue
+            changed.append(tag)
+            tag_dates[tag] = self._index_date(tag, href, description)
+        with self._parsed_lock:
+            for tag in list(self._parsed_tags):
+                if tag_handles.get(tag) != self._tag_handles[tag]:
+                    del self._parsed_tags[tag]
+            self._tag_handles = tag_handles
+        self.tag_dates = tag_dates
+        self._tag_files = tag_files
+        return changed
+
+    def _index_date(self, tag, href, description):
+        """
+        Return the modification date of the list for ``tag`` given in its
+        ``description`` in the index or, failing that, by the server.
+        """
+        try:
+            return datetime.strptime(" ".join(description.split()[:2]),
+                                     self.INDEX_DATE_FORMAT)
+        except ValueError:
+            u = http_client.urlopen(self.pkgroot + '/tags/' + href,
+                                    method="HEAD")
+            return datetime.strptime(u.info()['last-modified'],
+                                     "%a, %d %b %Y %H:%M:%S %Z")
+
+    def _entries(self, tag):
+        """
+        Return a tuple of the (product_name, version) tuples in ``tag``,
+        reading its list from the server if necessary.
+        """
+        with self._parsed_lock:
+            if tag not in self._tag_handles:
+                return ()
+            if tag in self._parsed_tags:
+                entries = self._parsed_tags.pop(tag)
+                self._parsed_tags[tag] = entries
+                return entries
+            description, href = self._tag_handles[tag]
+        tag, tag_date, entries = self._open_tag((tag, href))
+        entries = tuple((intern_string(product), intern_string(version))
+                        for product, version in entries)
+        with self._parsed_lock:
+            self._parsed_tags[tag] = entries
+            while len(self._parsed_tags) > self._max_tags:
+                self._parsed_tags.popitem(last=False)
+        return entries
+
+    def refresh(self):
+        tag_files, validators = self._read_index()
+        if tag_files is None or tag_files == self._tag_files:
+            self._index_validators = validators
+            return []
+        changed = self._load(tag_files, None)
+        self._index_validators = validators
+        return changed
+
+    def tags_for_product(self, product_name):
+        if product_name in self._assumed_products:
+            return set(self.tag_dates)
+        return set(tag for tag in self.tag_dates
+                   if any(name == product_name
+                          for name, version in self._entries(tag)))
+
+    def products_for_tag(self, tag):
+        return list(self._entries(tag))
+
+
+class InProcessEups(object):
+    """
+    Perform EUPS operations through the EUPS Python API in this process.
+
+    EUPS is imported from the stack being managed, and operations share a
+    single, long-lived ``eups.Eups`` object, so its database is only loaded
+    once rather than by every command. Only those operations we use
+    frequently are supported; ``run()`` returns None for anything else, in
+    which case the caller should run the ``eups`` command instead.
+    """
+    def __init__(self, stack_dir, environ):
+        """
+        Load EUPS from ``stack_dir``. All operations are performed in the
+        environment ``environ``.
+
+        Raises ImportError if EUPS cannot be found, or any other exception
+        raised while importing it (such as SyntaxError, if it is written for
+        another version of Python).
+        """
+        python_dir = os.path.join(stack_dir, "eups", "python")
+        if python_dir not in sys.path:
+            sys.path.insert(0, python_dir)
+        try:
+            import eups
+            import eups.hooks
+        except Exception:
+            sys.path.remove(python_dir)
+            raise
+        self._eups_module = eups
+        self._environ = environ
+        self._eups = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """
+        Create an ``eups.Eups`` object, equivalent to that created by the
+        ``eups --nolocks`` command.
+        """
+        eups = self._eups_module
+        eups.hooks.loadCustomization(path=eups.Eups.setEupsPath())
+        eups.hooks.config.site.lockDirectoryBase = None
+        return eups.Eups()
+
+    def _call(self, func, *args):
+        """
+        Call ``func(eups, *args)``, where eups is our ``eups.Eups`` object,
+        with ``os.environ`` temporarily replaced by our environment.
+        """
+        with self._lock, tracer.span("eups-api", func.__name__):
+            saved_environ = os.environ.copy()
+            os.environ.clear()
+            os.environ.update(self._environ)
+            try:
+                if self._eups is None:
+                    self._eups = self._connect()
+                return func(self._eups, *args)
+            finally:
+                os.environ.clear()
+                os.environ.update(saved_environ)
+
+    def invalidate(self):
+        """
+        Discard our view of the stack. Must be called after the stack has
+        been changed by other means (e.g. the ``eups`` command).
+        """
+        with self._lock:
+            self._eups = None
+
+    @staticmethod
+    def _list_raw(eups, product_name=None):
+        return "".join("%s|%s|%s\n" % (p.name, p.version, ":".join(p.tags))
+                       for p in eups.findProducts(product_name))
+
+    @staticmethod
+    def _tags(eups):
+        return " ".join(eups.tags.getTagNames()) + "\n"
+
+    @staticmethod
+    def _declare_tags(eups, pairs, tagname):
+        for product_name, version in pairs:
+            eups.assignTag(tagname, product_name, version)
+        return ""
+
+    def declare_tags(self, pairs, tagname):
+        """
+        Apply ``tagname`` to each of ``pairs``, a list of (product_name,
+        version) tuples.
+        """
+        self._call(self._declare_tags, pairs, tagname)
+
+    def run(self, cmd, *args):
+        """
+        Perform the equivalent of ``eups cmd *args``, returning its output,
+        or None if the command is not supported.
+        """
+        if cmd == "list" and args[:1] == ("--raw",) and len(args) <= 2:
+            return self._call(self._list_raw, *args[1:])
+        elif cmd == "tags" and not args:
+            return self._call(self._tags)
+        elif cmd == "declare" and args[:1] == ("-t",) and len(args) == 4:
+            return self._call(self._declare_tags, [args[2:]], args[1])
+        return None
+
+
+def parse_ups_db_file(path):
+    """
+    Parse a file from an EUPS database (a ``.version`` or ``.chain`` file).
+
+    Returns a tuple of a dictionary of the fields in the file header and a
+    list of dictionaries of the fields in each group (one per flavor). Field
+    names are upper-cased; quotes are stripped from values.
+    """
+    header, groups = {}, []
+    fields = header
+    with open(path) as f:
+        for line in f:
+            line = line.strip().lstrip("#").strip()
+            if line.upper() == "GROUP:":
+                fields = {}
+                groups.append(fields)
+            elif line.upper() == "END:":
+                fields = header
+            elif "=" in line:
+                key, value = line.split("=", 1)
+                fields[key.strip().upper()] = value.strip().strip('"')
+    return header, groups
+
+
+class UpsDbReader(object):
+    """
+    Read the products, versions and tags in a stack from its EUPS database.
+
+    The ``.version`` and ``.chain`` files in ``ups_db`` are read directly,
+    rather than by running ``eups list``. Parsed files are cached according
+    to their modification time, so that re-reading the database only parses
+    the files which have changed.
+    """
+    def __init__(self, ups_db, flavor, workers=UPS_DB_WORKERS):
+        """
+        Read the database in directory ``ups_db``, considering only entries
+        for ``flavor`` (or flavor-independent entries). Up to ``workers``
+        products are read simultaneously.
+        """
+        self.ups_db = ups_db
+        self.flavors = (flavor, "generic", "NULL")
+        self.workers = workers
+
+        # Map from file path to (modification time, size, parsed contents).
+        self._cache = {}
+
+    def _parse(self, entry):
+        """
+        Return the (cached) result of ``parse_ups_db_file()`` for ``entry``,
+        an ``os.DirEntry``.
+        """
+        st = entry.stat()
+        cached = self._cache.get(entry.path)
+        if cached and cached[:2] == (st.st_mtime, st.st_size):
+            return cached[2]
+        parsed = parse_ups_db_file(entry.path)
+        self._cache[entry.path] = (st.st_mtime, st.st_size, parsed)
+        return parsed
+
+    def _flavor_matches(self, groups):
+        return not groups or any(group.get("FLAVOR", "NULL") in self.flavors
+                                 for group in groups)
+
+    def _read_product(self, product_name):
         """
-        return (product_name in self._products and
-                version in self._products[product_name].versions())
-
-    def insert(self, product, version, tag=None):
+        Return a tuple of ``product_name`` and a list of (version, tags)
+        tuples, one for each version declared.
         """
-        Add (product, version, tag) to the list of products being tracked.
+        product_dir = os.path.join(self.ups_db, product_name)
+        versions = []
+        tags = {}
+        for entry in sorted(iter_dir(product_dir), key=lambda e: e.name):
+            if entry.name.endswith(".version"):
+                header, groups = self._parse(entry)
+                if self._flavor_matches(groups):
+                    versions.append(header.get("VERSION", entry.name[:-8]))
+            elif entry.name.endswith(".chain"):
+                header, groups = self._parse(entry)
+                tag = header.get("CHAIN", entry.name[:-6])
+                for group in groups:
+                    if group.get("FLAVOR", "NULL") in self.flavors:
+                        tags.setdefault(group.get("VERSION"), []).append(tag)
+        return product_name, [(version, tags.get(version, []))
+                              for version in versions]
+
+    def read(self, tracker, product_names=None):
         """
-        if product not in self._products:
-            self._products[product] = Product(product)
-        self._products[product].add_version(version)
-        if tag:
-            self._products[product].add_tag(version, tag)
-
+        Insert the products in the database into ``tracker``.
 
-class RepositoryManager(object):
+        If ``product_names`` is given, only those products are read.
+        """
+        if product_names is None:
+            product_names = sorted(entry.name for entry in
+                                   iter_dir(self.ups_db) if entry.is_dir())
+        else:
+            product_names = [product_name for product_name in product_names
+                             if os.path.isdir(os.path.join(self.ups_db,
+                                                           product_name))]
+        for product_name, versions in threaded_imap(self._read_product,
+                                                    product_names,
+                                                    self.workers):
+            for version, tags in versions:
+                tracker.insert(product_name, version)
+                for tag in tags:
+                    tracker.insert(product_name, version, tag)
+
+
+def shell_quote(value):
     """
-    Provide access to a ProductTracker built on a remote repository.
+    Quote ``value`` for use as a single word in sh or csh.
     """
-    def __init__(self, pkgroot=EUPS_PKGROOT, pattern=r".*"):
-        """
-        Only tags which match regular expression ``pattern`` are recorded.
-        More tags -> slower loading.
-        """
-        self._product_tracker = ProductTracker()
-        self.tag_dates = {}
-        self.pkgroot = pkgroot
+    return "'%s'" % (value.replace("'", "'\\''"),)
 
-        h = html.parse(urlopen(self.pkgroot + "/tags"))
-        for el in h.findall("./body/pre/a"):
-            if el.text[-5:] == ".list" and re.match(pattern, el.text):
-                u = urlopen(pkgroot + '/tags/' + el.get('href'))
-                tag_date = datetime.strptime(u.info()['last-modified'],
-                                             "%a, %d %b %Y %H:%M:%S %Z")
-                self.tag_dates[el.text[:-5]] = tag_date
-                for line in u.read().decode('utf-8').strip().split('\n'):
-                    if ("EUPS distribution %s version list" %
-                       (el.text[:-5]) in line):
-                        continue
-                    if line.strip()[0] == "#":
-                        continue
-                    product, flavor, version = line.split()
-                    self._product_tracker.insert(product, version,
-                                                 el.text[:-5])
 
-    def tags_for_product(self, product_name):
-        return self._product_tracker.tags_for_product(product_name)
+def sh_export(name, value, previous=None):
+    """
+    Return an sh command which sets the environment variable ``name`` to
+    ``value``, where it was ``previous`` when ``value`` was determined.
 
-    def products_for_tag(self, tag):
-        return self._product_tracker.products_for_tag(tag)
+    For search paths (variables whose name ends in "PATH"), only the entries
+    which were added to ``previous`` are set, ahead of the variable's value
+    when the command is run.
+    """
+    if name.endswith("PATH"):
+        if previous and value.endswith(":" + previous):
+            value = value[:-len(previous) - 1]
+        return 'export %s=%s"${%s:+:$%s}"\n' % (name, shell_quote(value),
+                                                 name, name)
+    return "export %s=%s\n" % (name, shell_quote(value))
+
+
+def csh_export(name, value, previous=None):
+    """
+    As ``sh_export()``, but for csh.
+    """
+    if name.endswith("PATH"):
+        if previous and value.endswith(":" + previous):
+            value = value[:-len(previous) - 1]
+        return ('if ($?%s) then\n    setenv %s %s":$%s"\nelse\n'
+                '    setenv %s %s\nendif\n' %
+                (name, name, shell_quote(value), name, name,
+                 shell_quote(value)))
+    return "setenv %s %s\n" % (name, shell_quote(value))
 
 
 class StackManager(object):
@@ -281,7 +2326,8 @@ class StackManager(object):
     creating and manipulating the stack.
     """
     def __init__(self, stack_dir, pkgroot=EUPS_PKGROOT,
-                 userdata=None, debug=DEBUG):
+                 userdata=None, debug=DEBUG, in_process=EUPS_IN_PROCESS,
+                 read_ups_db=READ_UPS_DB):
         """
         Create a StackManager to manage the stack in ``stack_dir``.
 
@@ -297,6 +2343,12 @@ class StackManager(object):
         conflict.
 
         Write verbose debugging information if ``debug`` is ``True``.
+
+        If ``in_process`` is ``True``, use the EUPS Python API in this process
+        (see InProcessEups) rather than the ``eups`` command where possible.
+
+        If ``read_ups_db`` is ``True``, read the state of the stack directly
+        from its EUPS database (see UpsDbReader) rather than through EUPS.
         """
         self.stack_dir = stack_dir
         self.flavor = determine_flavor()
@@ -321,21 +2373,84 @@ class StackManager(object):
         if userdata:
             self.eups_environ["EUPS_USERDATA"] = userdata
 
+        self._db_reader = None
+        if read_ups_db:
+            self._db_reader = UpsDbReader(os.path.join(stack_dir, "ups_db"),
+                                          self.flavor)
+
+        self._eups_api = None
+        if in_process:
+            try:
+                self._eups_api = InProcessEups(stack_dir, self.eups_environ)
+            except Exception as e:
+                # Typically ImportError, or SyntaxError when the stack's EUPS
+                # is written for another version of Python.
+                print("Cannot load the EUPS Python API (%s); "
+                      "using the eups command instead." % (e,))
+
         self._refresh_products()
 
-    def _refresh_products(self):
+    def _refresh_products(self, product_names=None):
         """
         Update the list of products we track in this stack.
 
         Should be run whenever the stack state is changed (e.g. by installing
-        new products).
+        new products). If ``product_names`` is given, only those products are
+        re-read; otherwise, the whole stack is.
         """
-        self._product_tracker = ProductTracker()
+        if self._db_reader:
+            if product_names is None:
+                self._product_tracker = ProductTracker()
+            else:
+                product_names = list(product_names)
+                for product_name in product_names:
+                    self._product_tracker.remove(product_name)
+            self._db_reader.read(self._product_tracker, product_names)
+        elif product_names is None:
+            self._product_tracker = ProductTracker()
+            self._insert_listing(self._run_cmd("list", "--raw"))
+        else:
+            # A single listing, of the one product or of the whole stack, is
+            # much cheaper than running eups for each product.
+            ups_db = os.path.join(self.stack_dir, "ups_db")
+            product_names = set(product_names)
+            for product_name in product_names:
+                self._product_tracker.remove(product_name)
+            listed = [product_name for product_name in product_names
+                      if os.path.isdir(os.path.join(ups_db, product_name))]
+            if len(listed) == 1:
+                self._insert_listing(self._run_cmd("list", "--raw",
+                                                   listed[0]))
+            elif listed:
+                self._insert_listing(self._run_cmd("list", "--raw"),
+                                     set(listed))
 
-        for line in self._run_cmd("list", "--raw").strip().split('\n'):
+        # If a current version of miniconda2 is available, add it to our
+        # environment.
+        try:
+            miniconda_version = self._product_tracker.current("miniconda2")
+        except IndexError:
+            miniconda_version = None
+        if miniconda_version:
+            miniconda_bin = os.path.join(self.stack_dir, self.flavor,
+                                         "miniconda2", miniconda_version,
+                                         "bin")
+            if miniconda_bin not in self.eups_environ["PATH"].split(":"):
+                self.eups_environ["PATH"] = "%s:%s" % (
+                    miniconda_bin, self.eups_environ["PATH"])
+
+    def _insert_listing(self, listing, product_names=None):
+        """
+        Add the products described by ``listing``, the output of ``eups list
+        --raw``, to our tracker. If ``product_names`` (a set) is given, other
+        products in the listing are ignored.
+        """
+        for line in listing.strip().split('\n'):
             if line == '':
                 continue
             product, version, tags = line.split("|")
+            if product_names is not None and product not in product_names:
+                continue
             if tags == '':
                 self._product_tracker.insert(product, version)
             for tag in tags.split(":"):
@@ -343,48 +2458,71 @@ class StackManager(object):
                     continue
                 self._product_tracker.insert(product, version, tag)
 
-        # If a current version of miniconda2 is available, add it to our
-        # environment.
-        try:
-            miniconda_version = self._product_tracker.current("miniconda2")
-        except IndexError:
-            miniconda_version = None
-        if miniconda_version:
-            miniconda_path = os.path.join(self.stack_dir, self.flavor,
-                                          "miniconda2", miniconda_version)
-            self.eups_environ["PATH"] = "%s:%s" % (os.path.join(miniconda_path,
-                                                                "bin"),
-                                                   self.eups_environ["PATH"])
+    def _ups_db_state(self):
+        """
+        Return a summary of the stack's EUPS database, suitable for
+        determining which products have changed between two calls.
+
+        The result maps the name of each product in ``ups_db`` to a sorted
+        list of (file name, modification time) tuples for the files
+        describing it.
+        """
+        ups_db = os.path.join(self.stack_dir, "ups_db")
+        state = {}
+        for product_name in os.listdir(ups_db):
+            product_dir = os.path.join(ups_db, product_name)
+            if not os.path.isdir(product_dir):
+                continue
+            state[product_name] = sorted(
+                (entry, os.path.getmtime(os.path.join(product_dir, entry)))
+                for entry in os.listdir(product_dir))
+        return state
 
     def _run_cmd(self, cmd, *args):
         """
         Run an ``eups`` command to manipulate the local stack.
         """
+        if self._eups_api:
+            output = self._eups_api.run(cmd, *args)
+            if output is not None:
+                return output
         to_exec = ['eups', '--nolocks', cmd]
         to_exec.extend(args)
         if self.debug:
             print(self.eups_environ)
             print(to_exec)
-        return StackManager._check_output(to_exec, env=self.eups_environ,
-                                          universal_newlines=True)
+        try:
+            return StackManager._check_output(to_exec, env=self.eups_environ,
+                                              universal_newlines=True)
+        finally:
+            # The command may have changed the stack underneath the API.
+            if self._eups_api:
+                self._eups_api.invalidate()
 
-    def conda(self, action, package_name, version=None):
+    def conda(self, action, packages, version=None):
         """
-        Perform ``action`` ("install", "remove", etc) on package named
-        ``package_name``. If supplied, version is appended to the package name
-        (thus ``package_name=version``).
+        Perform ``action`` ("install", "remove", etc) on ``packages``, a list
+        of conda package specifications (such as ``name`` or
+        ``name=version``), in a single transaction.
+
+        For compatibility, ``packages`` may instead be the name of a single
+        package; if supplied, ``version`` is then appended to it (thus
+        ``package_name=version``).
 
         Returns the output from executing the command.
         """
+        if isinstance(packages, str):
+            if version:
+                packages = "%s=%s" % (packages, version)
+            packages = [packages]
+        elif version:
+            raise ValueError("version may only be given with a single "
+                             "package name")
         if not self._product_tracker.current("miniconda2"):
             print("Miniconda not available; cannot %s %s" %
-                  (action, package_name))
+                  (action, " ".join(packages)))
             return
-        if version:
-            package = "%s=%s" % (package_name, version)
-        else:
-            package = package_name
-        to_exec = ["conda", action, "--yes", package]
+        to_exec = ["conda", action, "--yes"] + list(packages)
         if self.debug:
             print(self.eups_environ)
             print(to_exec)
@@ -394,28 +2532,180 @@ class StackManager(object):
     def tags_for_product(self, product_name):
         return self._product_tracker.tags_for_product(product_name)
 
+    def has_version(self, product_name, version):
+        return self._product_tracker.has_version(product_name, version)
+
     def version_from_tag(self, product_name, tag):
         """
         Return the version of ``product_name`` which is tagged ``tag``.
         """
-        for product, version in self._product_tracker.products_for_tag(tag):
-            if product == product_name:
-                return version
+        versions = self._product_tracker.versions_for_tag(product_name, tag)
+        if versions:
+            return versions[0]
 
-    def distrib_install(self, product_name, version=None, tag=None):
+    def distrib_install(self, product_name, version=None, tag=None,
+                        refresh=True):
         """
         Use ``eups distrib`` to install ``product_name``.
 
         If ``version`` and/or ``tag`` are specified, ask for them explicitly.
         Otherwise, accept the defaults.
+
+        If ``refresh`` is ``False``, our record of the stack is not updated;
+        the caller must call ``refresh_since()`` once the stack is no longer
+        being modified. This makes it safe to call from several threads at
+        once.
         """
         args = ["install", "--no-server-tags", product_name]
         if version:
             args.append(version)
         if tag:
             args.extend(["-t", tag])
+        before = self._ups_db_state() if refresh else None
         print(self._run_cmd("distrib", *args))
-        self._refresh_products()
+        if refresh:
+            self.refresh_since(before)
+
+    def refresh_since(self, before):
+        """
+        Update our record of the stack, re-reading only those products which
+        have changed since ``_ups_db_state()`` returned ``before``.
+        """
+        after = self._ups_db_state()
+        self._refresh_products(
+            product_name for product_name in set(before) | set(after)
+            if before.get(product_name) != after.get(product_name))
+
+    def staged_distrib_install(self, product_name, version):
+        """
+        Use ``eups distrib`` to install ``version`` of ``product_name`` into a
+        private staging area, then publish it into the stack.
+
+        The staging area is a directory within the stack which is placed
+        ahead of it on ``EUPS_PATH``: EUPS installs and declares new products
+        there, while finding those already in the stack as usual. Nothing is
+        visible in the stack until ``_publish()`` moves it in, so several
+        installations may safely run at once.
+
+        As for ``distrib_install(refresh=False)``, our record of the stack is
+        not updated; the caller must call ``refresh_since()``.
+        """
+        staging_root = os.path.join(self.stack_dir, STAGING_DIR)
+        try:
+            os.makedirs(staging_root)
+        except OSError:
+            if not os.path.isdir(staging_root):
+                raise
+        stage_dir = tempfile.mkdtemp(prefix="%s-%s-" % (product_name, version),
+                                     dir=staging_root)
+        try:
+            for sub_dir in ("ups_db", "userdata"):
+                os.mkdir(os.path.join(stage_dir, sub_dir))
+            environ = dict(self.eups_environ)
+            environ.update({
+                "EUPS_PATH": "%s:%s" % (stage_dir, self.stack_dir),
+                # EUPS caches its view of each EUPS_PATH entry here; a shared
+                # cache would be written by several installations at once.
+                "EUPS_USERDATA": os.path.join(stage_dir, "userdata")
+            })
+            to_exec = ["eups", "--nolocks", "distrib", "install",
+                       "--no-server-tags", product_name, version]
+            if self.debug:
+                print(to_exec)
+            print(StackManager._check_output(to_exec, env=environ,
+                                             universal_newlines=True))
+            with self._publish_lock():
+                self._publish(stage_dir)
+        finally:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            if self._eups_api:
+                self._eups_api.invalidate()
+
+    @contextmanager
+    def _publish_lock(self):
+        """
+        Hold an exclusive lock on the stack's staging area, shared with any
+        other process publishing into the stack.
+        """
+        with open(os.path.join(self.stack_dir, STAGING_DIR, "lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _publish(self, stage_dir):
+        """
+        Move the products declared in the staging area ``stage_dir`` into the
+        stack.
+
+        Product directories are moved first and their declarations last, each
+        with a single rename, so that the stack never declares a product which
+        is not fully in place. References to ``stage_dir`` in declarations
+        are rewritten to refer to the stack. A product version which the stack
+        already has (installed by someone else in the meantime) is discarded,
+        as are tags which the stack already carries.
+        """
+        stage_db = os.path.join(stage_dir, "ups_db")
+        declarations = []
+        for product_entry in iter_dir(stage_db):
+            if not product_entry.is_dir():
+                continue
+            for entry in iter_dir(product_entry.path):
+                declarations.append((product_entry.name, entry.name))
+
+        for product_name, file_name in declarations:
+            if not file_name.endswith(".version"):
+                continue
+            version = file_name[:-len(".version")]
+            if os.path.exists(os.path.join(self.stack_dir, "ups_db",
+                                           product_name, file_name)):
+                continue
+            header, groups = parse_ups_db_file(
+                os.path.join(stage_db, product_name, file_name))
+            prod_dir = os.path.join(self.flavor, product_name, version)
+            for fields in groups:
+                if fields.get("PROD_DIR"):
+                    prod_dir = fields["PROD_DIR"]
+                    break
+            if os.path.isabs(prod_dir):
+                prod_dir = os.path.relpath(prod_dir, stage_dir)
+            if prod_dir.startswith(os.pardir):
+                # Declared outside the staging area; nothing to move.
+                continue
+            source = os.path.join(stage_dir, prod_dir)
+            target = os.path.join(self.stack_dir, prod_dir)
+            if not os.path.isdir(source):
+                continue
+            if os.path.exists(target):
+                raise RuntimeError("Cannot publish %s %s: %s already exists" %
+                                   (product_name, version, target))
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            os.rename(source, target)
+
+        # Declarations, then tags, so that a tag never names a version which
+        # has not yet been declared.
+        declarations.sort(key=lambda d: (not d[1].endswith(".version"), d))
+        for product_name, file_name in declarations:
+            product_db = os.path.join(self.stack_dir, "ups_db", product_name)
+            target = os.path.join(product_db, file_name)
+            if os.path.exists(target):
+                continue
+            if not os.path.isdir(product_db):
+                os.makedirs(product_db)
+            source = os.path.join(stage_db, product_name, file_name)
+            with open(source) as f:
+                content = f.read().replace(stage_dir, self.stack_dir)
+            fd, tmp_path = tempfile.mkstemp(dir=product_db)
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(content)
+                shutil.copymode(source, tmp_path)
+                os.rename(tmp_path, target)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
 
     def add_global_tag(self, tagname):
         """
@@ -429,6 +2719,8 @@ class StackManager(object):
         with open(startup_path, "a") as startup_py:
             startup_py.write('hooks.config.Eups.globalTags += ["%s"]\n' %
                              (tagname,))
+        if self._eups_api:
+            self._eups_api.invalidate()
 
     def tags(self):
         """
@@ -447,9 +2739,337 @@ class StackManager(object):
             self._run_cmd("declare", "-t", tagname, product_name, version)
             self._product_tracker.insert(product_name, version, tagname)
 
+    def apply_tags(self, pairs, tagname):
+        """
+        Apply ``tagname`` to each of ``pairs``, an iterable of
+        (product_name, version) tuples.
+
+        This is equivalent to calling ``apply_tag()`` for each pair, but all
+        the declarations are made by a single process, and our record of the
+        stack is updated once they have all succeeded. If any fail, the
+        products concerned are re-read from the stack instead.
+        """
+        pairs = [(product_name, version) for product_name, version in pairs
+                 if self._product_tracker.has_version(product_name, version)]
+        if not pairs:
+            return
+        try:
+            if self._eups_api:
+                self._eups_api.declare_tags(pairs, tagname)
+            else:
+                to_exec = self._eups_python()
+                to_exec.extend(["-c", DECLARE_TAGS_SCRIPT, tagname,
+                                "--nolocks"])
+                if self.debug:
+                    print(self.eups_environ)
+                    print(to_exec)
+                StackManager._check_output(to_exec, env=self.eups_environ,
+                                           universal_newlines=True,
+                                           input="".join("%s %s\n" % pair
+                                                         for pair in pairs))
+        except Exception:
+            # Some of the declarations may have been made.
+            self._refresh_products(set(product_name
+                                       for product_name, version in pairs))
+            raise
+        for product_name, version in pairs:
+            self._product_tracker.insert(product_name, version, tagname)
+
+    def deduplicate(self, paths=None, workers=DEDUPLICATE_WORKERS):
+        """
+        Replace files in the stack which are identical to others with hard
+        links to a single copy.
+
+        Files are identical if they have the same size, content (by SHA-256
+        digest), permissions, owner and group; Python source files must also
+        have the same modification time, since linking would otherwise give
+        one of them a time which no longer matches that recorded in its
+        compiled bytecode. The files in ``paths`` (for
+        example, newly installed products) are compared with all those seen
+        before, as recorded in the stack's ``DEDUPLICATE_INDEX``; if
+        ``paths`` is None, the whole stack is scanned and the index rebuilt.
+        Only files whose size matches that of another are read.
+
+        Installed products must not be modified in place afterwards, since
+        every link would see the change.
+
+        Returns the number of files replaced and the bytes saved.
+        """
+        root = os.path.join(self.stack_dir, self.flavor)
+        index = FileHashIndex(os.path.join(self.stack_dir, DEDUPLICATE_INDEX))
+        if paths is None:
+            paths = [root]
+            index.entries = {}
+        paths = [path for path in paths if os.path.isdir(path)]
+
+        # Record the files we have been asked to look at, keeping the digests
+        # of those which have not changed.
+        stats = {}
+        for directory, files in parallel_walk(paths, regular_files, workers):
+            for path, st in files:
+                if st.st_size == 0:
+                    continue
+                relpath = os.path.relpath(path, root)
+                stats[relpath] = st
+                entry = index.entries.get(relpath)
+                if not entry or not FileHashIndex.matches(entry, st):
+                    index.entries[relpath] = FileHashIndex.entry(st)
+
+        # Only files of the same size can be identical; read those that have
+        # not been read before. Files recorded on a previous run are checked
+        # first, in case they have changed or gone.
+        by_size = {}
+        for relpath, entry in index.entries.items():
+            by_size.setdefault(entry[0], []).append(relpath)
+
+        def digest(relpath):
+            path = os.path.join(root, relpath)
+            try:
+                st = stats.get(relpath) or os.lstat(path)
+                if not FileHashIndex.matches(index.entries[relpath], st):
+                    return relpath, None
+                return relpath, file_digest(path)
+            except (IOError, OSError):
+                return relpath, None
+
+        unread = [relpath for relpaths in by_size.values()
+                  if len(relpaths) > 1 for relpath in relpaths
+                  if index.entries[relpath][7] is None]
+        for relpath, file_hash in threaded_imap(digest, unread, workers):
+            if file_hash is None:
+                del index.entries[relpath]
+            else:
+                index.entries[relpath][7] = file_hash
+
+        groups = {}
+        for relpath, entry in index.entries.items():
+            if entry[7] is not None:
+                size, mtime, dev, ino, mode, uid, gid, file_hash = entry
+                if not relpath.endswith(".py"):
+                    mtime = None
+                groups.setdefault((size, file_hash, dev, mode, uid, gid,
+                                   mtime), []).append(relpath)
+
+        linked, saved = 0, 0
+        for key, relpaths in groups.items():
+            inodes = set(index.entries[relpath][3] for relpath in relpaths)
+            if len(inodes) < 2:
+                continue
+            # Keep the copy which already has the most links, provided it is
+            # still there.
+            links = {}
+            for relpath in relpaths:
+                ino = index.entries[relpath][3]
+                links[ino] = links.get(ino, 0) + 1
+            relpaths.sort(key=lambda relpath: (
+                -links[index.entries[relpath][3]], relpath))
+            original_st = None
+            while relpaths and original_st is None:
+                original = os.path.join(root, relpaths[0])
+                try:
+                    original_st = os.lstat(original)
+                except OSError:
+                    pass
+                if (original_st is None or not FileHashIndex.matches(
+                        index.entries[relpaths[0]], original_st)):
+                    original_st = None
+                    del index.entries[relpaths.pop(0)]
+            for relpath in relpaths[1:]:
+                entry = index.entries[relpath]
+                if entry[3] == original_st.st_ino:
+                    continue
+                path = os.path.join(root, relpath)
+                try:
+                    if not FileHashIndex.matches(entry, os.lstat(path)):
+                        continue
+                    # Link alongside, then rename over the duplicate, so the
+                    # path is never missing.
+                    tmp_path = path + ".hardlink-tmp"
+                    os.link(original, tmp_path)
+                    os.rename(tmp_path, path)
+                except OSError as e:
+                    print("Cannot link %s to %s: %s" % (path, original, e))
+                    continue
+                index.entries[relpath] = FileHashIndex.entry(original_st,
+                                                             entry[7])
+                linked += 1
+                saved += entry[0]
+        index.save()
+        if linked:
+            print("Replaced %d duplicate files with hard links, saving %d "
+                  "bytes" % (linked, saved))
+        return linked, saved
+
+    def _product_dir(self, product_name, version):
+        """
+        Return the directory in which ``version`` of ``product_name`` is
+        installed, according to its EUPS declaration.
+        """
+        path = os.path.join(self.stack_dir, self.flavor, product_name, version)
+        try:
+            header, groups = parse_ups_db_file(
+                os.path.join(self.stack_dir, "ups_db", product_name,
+                             version + ".version"))
+        except (IOError, OSError):
+            return path
+        for fields in groups:
+            if fields.get("PROD_DIR"):
+                path = os.path.join(self.stack_dir, fields["PROD_DIR"])
+                break
+        return path
+
+    def prune_tags(self, tags, dry_run=False, workers=RETENTION_WORKERS):
+        """
+        Remove ``tags`` from the stack. Product versions which then carry no
+        tag at all are undeclared and deleted, up to ``workers`` at a time.
+
+        If ``dry_run`` is ``True``, only report what would be removed.
+
+        Returns a list of the (product_name, version) tuples removed.
+        """
+        tags = set(tags)
+        untag, remove = [], set()
+        for tag in sorted(tags):
+            for pair in self._product_tracker.products_for_tag(tag):
+                untag.append(pair + (tag,))
+                if not self._product_tracker.tags_for_version(*pair) - tags:
+                    remove.add(pair)
+        remove = sorted(remove)
+        if not untag:
+            return []
+
+        print("%s %d tags (%s) and %d product versions" %
+              ("Would remove" if dry_run else "Removing", len(tags),
+               ", ".join(sorted(tags)), len(remove)))
+        for product_name, version in remove:
+            print("  %s %s" % (product_name, version))
+        if dry_run:
+            return remove
+
+        product_dirs = [self._product_dir(*pair) for pair in remove]
+        to_exec = self._eups_python()
+        to_exec.extend(["-c", UNDECLARE_SCRIPT, "--nolocks"])
+        if self.debug:
+            print(self.eups_environ)
+            print(to_exec)
+        try:
+            StackManager._check_output(
+                to_exec, env=self.eups_environ, universal_newlines=True,
+                input="".join(["%s %s %s\n" % entry for entry in untag] +
+                              ["%s %s\n" % pair for pair in remove]))
+        finally:
+            if self._eups_api:
+                self._eups_api.invalidate()
+
+        stack_dir = os.path.realpath(self.stack_dir)
+
+        def delete(path):
+            path = os.path.realpath(path)
+            # Never stray outside the stack.
+            if (path.startswith(stack_dir + os.sep) and
+                    os.path.isdir(path)):
+                shutil.rmtree(path)
+                try:
+                    # Remove the product's directory if this was its last
+                    # version.
+                    os.rmdir(os.path.dirname(path))
+                except OSError:
+                    pass
+
+        for _ in threaded_imap(delete, product_dirs, workers):
+            pass
+        self._refresh_products(set(entry[0] for entry in untag))
+        return remove
+
+    def write_fast_loaders(self, products=PRODUCTS):
+        """
+        Write ``loadLSST-fast.{bash,csh,ksh,zsh}`` scripts which reproduce
+        the environment obtained by setting up miniconda2 and the current
+        versions of ``products``, without running EUPS.
+
+        The environment is captured by setting the products up once, here.
+        The scripts are only rewritten when the current versions change.
+        Unlike ``loadLSST.*``, they do not provide the EUPS commands
+        (``setup``, etc).
+        """
+        products = ["miniconda2"] + list(products)
+        # Tags may have moved since we last read these products.
+        self._refresh_products(products)
+        current = []
+        for product_name in products:
+            try:
+                version = self._product_tracker.current(product_name)
+            except IndexError:
+                version = None
+            if version:
+                current.append("%s %s" % (product_name, version))
+        if not current:
+            return
+
+        # The scripts record what they were generated for.
+        stamp = "# Environment for: %s\n" % (", ".join(current),)
+        loader_path = os.path.join(self.stack_dir, "loadLSST-fast.%s")
+        try:
+            with open(loader_path % ("bash",)) as f:
+                if stamp in f.read():
+                    return
+        except IOError:
+            pass
+
+        before, after = self._setup_environment(
+            [product.split()[0] for product in current])
+        for suffix, export in (("bash", sh_export), ("csh", csh_export),
+                               ("ksh", sh_export), ("zsh", sh_export)):
+            lines = ["# Generated by shared_stack.py; do not edit.\n", stamp]
+            for name in sorted(after):
+                if (name in ("_", "PWD", "OLDPWD", "SHLVL") or
+                        after[name] == before.get(name)):
+                    continue
+                lines.append(export(name, after[name], before.get(name)))
+            fd, tmp_path = tempfile.mkstemp(dir=self.stack_dir)
+            with os.fdopen(fd, "w") as f:
+                f.writelines(lines)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, loader_path % (suffix,))
+
+    def _setup_environment(self, products):
+        """
+        Set up ``products`` in a shell with a minimal environment, returning
+        dictionaries of the environment before and after.
+        """
+        dump = ('"%s" -c "import json, os, sys; '
+                'sys.stdout.write(json.dumps(dict(os.environ)) + chr(10))"' %
+                (sys.executable,))
+        script = " && ".join(
+            [dump, ". %s" % (os.path.join(self.stack_dir, "eups", "bin",
+                                          "setups.sh"),)] +
+            ["setup %s" % (product_name,) for product_name in products] +
+            [dump])
+        environ = {"PATH": "/usr/local/bin:/usr/bin:/bin",
+                   "HOME": os.environ.get("HOME", "/")}
+        if "EUPS_USERDATA" in self.eups_environ:
+            environ["EUPS_USERDATA"] = self.eups_environ["EUPS_USERDATA"]
+        output = StackManager._check_output(["sh", "-c", script], env=environ,
+                                            universal_newlines=True)
+        lines = output.strip().split("\n")
+        return json.loads(lines[0]), json.loads(lines[-1])
+
+    def _eups_python(self):
+        """
+        Return the command (as a list) which runs the Python interpreter EUPS
+        was installed with, as recorded in the ``eups`` script's "#!" line.
+        """
+        eups_script = os.path.join(self.stack_dir, "eups", "bin", "eups")
+        with open(eups_script) as f:
+            first_line = f.readline()
+        if first_line.startswith("#!"):
+            return first_line[2:].split()
+        return ["python"]
+
     @staticmethod
     def create_stack(stack_dir, pkgroot=EUPS_PKGROOT, userdata=None,
-                     python="/usr/bin/python", debug=DEBUG):
+                     python="/usr/bin/python", debug=DEBUG,
+                     in_process=EUPS_IN_PROCESS, artifact_cache=None):
         """
         Bootstrap a stack in ``stack_dir``.
 
@@ -459,54 +3079,68 @@ class StackManager(object):
         The ``python`` argument is only used for bootstrapping EUPS: for
         working with the stack, we will use Anaconda.
 
+        If ``artifact_cache`` (an ArtifactCache) is supplied, the EUPS source
+        and installation, and conda packages, are reused from it where
+        possible, and added to it otherwise. Since the paths to the stack and
+        to ``python`` are built into the EUPS installation, it is only reused
+        for the same ``stack_dir``, ``python`` and ``EUPS_VERSION``.
+
         Other arguments are as for ``StackManager.__init__()``.
         """
         # Refuses to proceed if ``stack_dir`` already exists.
         os.makedirs(stack_dir)
 
         # Install EUPS into the stack directory.
-        EUPS_URL = "https://github.com/RobertLuptonTheGood/eups/archive/%s.tar.gz" % (EUPS_VERSION,)
-        eups_download = urlopen(EUPS_URL)
-        tf = tarfile.open(fileobj=eups_download, mode="r|gz")
-        eups_build_dir = tempfile.mkdtemp()
-        try:
-            tf.extractall(eups_build_dir)
-            StackManager._check_output(["./configure",
-                                        "-prefix=%s/eups" % (stack_dir,),
-                                        "--with-eups=%s" % (stack_dir,),
-                                        "--with-python=%s" % (python,)],
-                                       cwd=os.path.join(eups_build_dir,
-                                                        "eups-%s" % (EUPS_VERSION,)))
-            StackManager._check_output(["make", "install"],
-                                       cwd=os.path.join(eups_build_dir,
-                                                        "eups-%s" % (EUPS_VERSION,)))
+        eups_key = None
+        if artifact_cache:
+            python_version = StackManager._check_output(
+                [python, "-c", "import sys; print(sys.version)"],
+                universal_newlines=True)
+            eups_key = json.dumps([EUPS_VERSION, stack_dir,
+                                   os.path.realpath(python), python_version])
+        if eups_key and artifact_cache.restore_tree(eups_key, stack_dir):
+            if debug:
+                print("Restored EUPS %s from cache" % (EUPS_VERSION,))
+        else:
+            StackManager._build_eups(stack_dir, python, artifact_cache)
+            if eups_key:
+                artifact_cache.store_tree(eups_key,
+                                          os.path.join(stack_dir, "eups"),
+                                          "eups")
             if debug:
                 print("Done installing EUPS %s" % (EUPS_VERSION,))
-        finally:
-            shutil.rmtree(eups_build_dir)
 
         sm = StackManager(stack_dir, pkgroot=pkgroot,
-                          userdata=userdata, debug=debug)
+                          userdata=userdata, debug=debug,
+                          in_process=in_process)
+        if artifact_cache:
+            sm.eups_environ["CONDA_PKGS_DIRS"] = artifact_cache.conda_pkgs_dir
         sm.distrib_install("miniconda2", version=MINICONDA2_VERSION)
         sm.apply_tag("miniconda2", MINICONDA2_VERSION, "current")
         if debug:
             print("Miniconda installed.")
 
-        sm.conda("install", "anaconda", ANACONDA_VERSION)
-        for package in "nomkl numpy scipy scikit-learn numexpr".split():
-            sm.conda("install", package)
-        for package in "mkl mkl-service".split():
+        for action, packages in CONDA_ENVIRONMENT:
+            if action != "remove":
+                sm.conda(action, packages)
+                continue
             try:
-                sm.conda("remove", package)
+                sm.conda(action, packages)
             except subprocess.CalledProcessError:
-                print("Failed to remove conda package %s;" % (package, ), end=" ")
-                print("pressing on regardless.")
+                # Perhaps some were not installed; remove the rest one by
+                # one.
+                for package in packages:
+                    try:
+                        sm.conda(action, [package])
+                    except subprocess.CalledProcessError:
+                        print("Failed to remove conda package %s;" %
+                              (package, ), end=" ")
+                        print("pressing on regardless.")
         # Set the permissions on the Anaconda dir to avoid end users
         # creating undeletable .pyc files.
-        StackManager._check_output(["chmod", "-R", "g-w",
-                                    os.path.join(stack_dir, determine_flavor(),
-                                                 "miniconda2",
-                                                 MINICONDA2_VERSION)])
+        with tracer.span("phase", "finalize"):
+            sm.finalize([os.path.join(stack_dir, sm.flavor, "miniconda2",
+                                      MINICONDA2_VERSION)])
         if debug:
             print("Upgraded to Anaconda %s" % (ANACONDA_VERSION,))
 
@@ -527,17 +3161,104 @@ class StackManager(object):
         sm.distrib_install("lsst")
         return sm
 
+    def finalize(self, paths, workers=FINALIZE_WORKERS,
+                 precompile=PRECOMPILE_BYTECODE):
+        """
+        Prepare the directory trees at ``paths`` (newly installed products,
+        for example) for use by others.
+
+        Group write permission is removed throughout, so that users cannot
+        create files (such as ``.pyc`` files) which we cannot delete. If
+        ``precompile`` is ``True``, Python modules are first compiled to
+        bytecode with the stack's Python, so that users need not.
+
+        Up to ``workers`` directories, or batches of directories to compile,
+        are processed at the same time.
+        """
+        paths = [path for path in paths if os.path.isdir(path)]
+        for path in paths:
+            mode = os.stat(path).st_mode
+            os.chmod(path, stat.S_IMODE(mode) & ~stat.S_IWGRP)
+        python_dirs = [path for path, has_python
+                       in parallel_walk(paths, remove_group_write, workers)
+                       if has_python]
+
+        if not precompile or not python_dirs:
+            return
+
+        def compile_dirs(dirs):
+            # compileall does not recurse with -l; we have found every
+            # directory already. The bytecode is written without group write
+            # permission; the umask is set by the shell, since preexec_fn is
+            # not safe to use from threads.
+            try:
+                StackManager._check_output(
+                    ["sh", "-c",
+                     'umask 022 && exec python -m compileall -q -l "$@"',
+                     "sh"] + dirs,
+                    env=self.eups_environ)
+            except subprocess.CalledProcessError:
+                # Typically modules which are not valid in this version of
+                # Python; the remainder will have been compiled.
+                print("Some Python modules could not be compiled.")
+
+        batch_size = 100
+        for _ in threaded_imap(compile_dirs,
+                               [python_dirs[i:i + batch_size] for i in
+                                range(0, len(python_dirs), batch_size)],
+                               workers):
+            pass
+
+    @staticmethod
+    def _build_eups(stack_dir, python, artifact_cache=None):
+        """
+        Download, build and install EUPS into ``stack_dir``, using the
+        ``artifact_cache`` (if any) for the download.
+        """
+        EUPS_URL = "https://github.com/RobertLuptonTheGood/eups/archive/%s.tar.gz" % (EUPS_VERSION,)
+        if artifact_cache:
+            eups_download = open(artifact_cache.fetch(EUPS_URL, EUPS_SHA256),
+                                 "rb")
+        else:
+            eups_download = http_client.urlopen(EUPS_URL)
+        tf = tarfile.open(fileobj=eups_download, mode="r|gz")
+        eups_build_dir = tempfile.mkdtemp()
+        try:
+            tf.extractall(eups_build_dir)
+            StackManager._check_output(["./configure",
+                                        "-prefix=%s/eups" % (stack_dir,),
+                                        "--with-eups=%s" % (stack_dir,),
+                                        "--with-python=%s" % (python,)],
+                                       cwd=os.path.join(eups_build_dir,
+                                                        "eups-%s" % (EUPS_VERSION,)))
+            StackManager._check_output(["make", "install"],
+                                       cwd=os.path.join(eups_build_dir,
+                                                        "eups-%s" % (EUPS_VERSION,)))
+        finally:
+            eups_download.close()
+            shutil.rmtree(eups_build_dir)
+
     @staticmethod
     def _check_output(*popenargs, **kwargs):
         """
         Run an external command, check its exit status, and return its output.
         """
-        # This is effectively  subprocess.check_output() function from
-        # Python 2.7+ provided here for compatibility with Python 2.6.
-        process = subprocess.Popen(stdout=subprocess.PIPE,
-                                   *popenargs, **kwargs)
-        output, unused_err = process.communicate()
-        retcode = process.poll()
+        # This is effectively subprocess.check_output(), which only accepts
+        # ``input`` (sent to the process's stdin) from Python 3.4, with the
+        # command recorded by the tracer.
+        input = kwargs.pop("input", None)
+        if input is not None:
+            kwargs["stdin"] = subprocess.PIPE
+        argv = kwargs.get("args", popenargs[0] if popenargs else None)
+        with tracer.span("subprocess", describe_command(argv),
+                         argv=[arg if len(arg) < 200 else arg[:200] + "..."
+                               for arg in argv]) as trace_args:
+            process = subprocess.Popen(stdout=subprocess.PIPE,
+                                       *popenargs, **kwargs)
+            output, unused_err = process.communicate(input)
+            retcode = process.poll()
+            trace_args["bytes"] = len(output)
+            trace_args["returncode"] = retcode
         if retcode:
             cmd = kwargs.get("args")
             print("Failed process output:")
@@ -548,36 +3269,310 @@ class StackManager(object):
         return output
 
 
-def main(stack_dir):
-    # We create a temporary directory for the EUPS cache etc. This means we
-    # can run multiple instances of StackManager simultaneously without them
-    # clobbering each other.
-    userdata = tempfile.mkdtemp()
+class InstallScheduler(object):
+    """
+    Install products into a stack concurrently, in dependency order.
+
+    The dependencies of each product are taken from its manifest on the
+    server. A product is only installed once everything it depends on has
+    been; independent products are installed simultaneously. If a product
+    fails to install, those which depend on it are skipped, but unrelated
+    products are still installed.
 
-    # If the stack doesn't already exist, create it.
-    if not os.path.exists(stack_dir):
-        sm = StackManager.create_stack(stack_dir, userdata=userdata)
-    else:
-        sm = StackManager(stack_dir, userdata=userdata)
+    If ``staged`` is ``True``, each product is built in its own staging area
+    and published into the stack when complete (see
+    ``StackManager.staged_distrib_install()``).
+    """
+    def __init__(self, stack_manager, repository_manager,
+                 workers=INSTALL_WORKERS, staged=STAGED_INSTALLS):
+        self.stack_manager = stack_manager
+        self.repository_manager = repository_manager
+        self.staged = staged
+        if workers > 1 and not staged:
+            # EUPS runs without locks, so concurrent installations directly
+            # into the stack would corrupt its database.
+            print("Installing one product at a time: more than one install "
+                  "worker requires STAGED_INSTALLS.")
+            workers = 1
+        self.workers = workers
+
+    def _dependency_graph(self, pairs):
+        """
+        Return a map from each of ``pairs`` to the set of the others on which
+        it depends, and a map from each pair whose manifest could not be read
+        to the exception raised.
+        """
+        pair_set = set(pairs)
+
+        def depends_on(pair):
+            try:
+                return pair, set(
+                    dependency for dependency in
+                    self.repository_manager.dependencies(*pair)
+                    if dependency in pair_set), None
+            except Exception as e:
+                return pair, set(), e
+
+        graph, errors = {}, {}
+        for pair, dependencies, error in threaded_imap(depends_on, pairs,
+                                                       FETCH_WORKERS):
+            graph[pair] = dependencies
+            if error is not None:
+                errors[pair] = error
+        return graph, errors
+
+    def _install_one(self, pair, done):
+        """
+        Install ``pair`` and report the outcome, a tuple of ``pair`` and
+        either None or the exception raised, through ``done``.
+        """
+        product_name, version = pair
+        print("  Installing %s %s" % (product_name, version))
+        try:
+            if self.staged:
+                self.stack_manager.staged_distrib_install(product_name,
+                                                          version)
+            else:
+                self.stack_manager.distrib_install(product_name, version,
+                                                   refresh=False)
+        except Exception as e:
+            done.put((pair, e))
+        else:
+            done.put((pair, None))
+
+    def install(self, pairs):
+        """
+        Install ``pairs``, a list of (product_name, version) tuples.
+
+        Returns a tuple of lists of the pairs which were installed, which
+        failed to install, and which were skipped because something they
+        depend on failed.
+        """
+        depends_on, errors = self._dependency_graph(pairs)
+        dependents = dict((pair, set()) for pair in pairs)
+        for pair, dependencies in depends_on.items():
+            for dependency in dependencies:
+                dependents[dependency].add(pair)
+        waiting_for = dict((pair, len(depends_on[pair])) for pair in pairs)
+        installed, failed, skipped = [], [], []
+
+        def fail(pair, error):
+            print("  Failed to install %s %s: %s" % (pair + (error,)))
+            failed.append(pair)
+            waiting_for[pair] = None
+            # Nothing which depends on this pair can now be installed.
+            blocked = list(dependents[pair])
+            while blocked:
+                dependent = blocked.pop()
+                if waiting_for[dependent] is not None:
+                    waiting_for[dependent] = None
+                    skipped.append(dependent)
+                    blocked.extend(dependents[dependent])
+
+        # Products whose dependencies are unknown cannot be installed.
+        for pair in errors:
+            waiting_for[pair] = None
+        for pair in pairs:
+            if pair in errors:
+                fail(pair, errors[pair])
+
+        ready = [pair for pair in pairs if waiting_for[pair] == 0]
+        done = Queue()
+        running = 0
+        before = self.stack_manager._ups_db_state()
+        pool = ThreadPool(max(self.workers, 1))
+        try:
+            while ready or running:
+                for pair in ready:
+                    pool.apply_async(self._install_one, (pair, done))
+                running += len(ready)
+                ready = []
+
+                pair, error = done.get()
+                running -= 1
+                if error is None:
+                    installed.append(pair)
+                    for dependent in sorted(dependents[pair]):
+                        if waiting_for[dependent] is None:
+                            continue
+                        waiting_for[dependent] -= 1
+                        if not waiting_for[dependent]:
+                            ready.append(dependent)
+                    continue
+                fail(pair, error)
+        finally:
+            pool.close()
+            pool.join()
+            self.stack_manager.refresh_since(before)
+
+        # Anything left (e.g. a dependency cycle) could not be installed.
+        skipped.extend(pair for pair in pairs if waiting_for[pair] and
+                       pair not in skipped)
+        for pair in skipped:
+            print("  Skipped %s %s" % pair)
+        return installed, failed, skipped
+
+
+class InstallPlan(object):
+    """
+    The work required to bring a set of tags from the server into a stack.
+    """
+    def __init__(self, tags, installs, tagged, download_size, unknown_sizes):
+        # Tags to be applied, in order.
+        self.tags = tags
+        # (product_name, version) tuples to be installed, each exactly once.
+        self.installs = installs
+        # Number of (product_name, version) tuples in the tags which are
+        # already in the stack and only need to be tagged.
+        self.tagged = tagged
+        # Total size in bytes of the packages to be installed, excluding the
+        # ``unknown_sizes`` packages for which the size is not known.
+        self.download_size = download_size
+        self.unknown_sizes = unknown_sizes
+
+    def describe(self):
+        """
+        Return a human-readable description of the plan.
+        """
+        lines = ["  Plan for %s:" % (", ".join(self.tags),),
+                 "    Install %d product versions (%.1f MiB to download%s)" %
+                 (len(self.installs), self.download_size / 1024.0**2,
+                  "; %d of unknown size" % (self.unknown_sizes,)
+                  if self.unknown_sizes else ""),
+                 "    Tag %d product versions already installed" %
+                 (self.tagged,)]
+        lines.extend("      %s %s" % pair for pair in self.installs)
+        return "\n".join(lines)
+
+
+class InstallPlanner(object):
+    """
+    Plan and carry out the installation of several tags at once.
+
+    Consecutive tags typically share most of their (product, version) pairs.
+    Rather than asking EUPS to install each tag in turn, we take the union of
+    the products required from each tag, install only those pairs which are
+    missing from the stack, each exactly once, and then apply the tags.
+    """
+    def __init__(self, stack_manager, repository_manager,
+                 workers=INSTALL_WORKERS):
+        self.stack_manager = stack_manager
+        self.repository_manager = repository_manager
+        self.workers = workers
+
+    def plan(self, tags, product_names=PRODUCTS):
+        """
+        Return an InstallPlan for the ``tags`` (a list) on the server.
+
+        Only ``product_names`` and their dependencies are installed from each
+        tag, just as ``eups distrib install -t`` would; anything else the tag
+        carries is left on the server.
+        """
+        installs, seen, tagged = [], set(), 0
+        for tag in tags:
+            for pair in self.repository_manager.tag_closure(tag,
+                                                            product_names):
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                if self.stack_manager.has_version(*pair):
+                    tagged += 1
+                else:
+                    installs.append(pair)
+
+        def size(pair):
+            return self.repository_manager.distribution_size(*pair)
+
+        sizes = list(threaded_imap(size, installs, FETCH_WORKERS))
+        return InstallPlan(list(tags), installs, tagged,
+                           sum(s for s in sizes if s is not None),
+                           sizes.count(None))
+
+    def execute(self, plan):
+        """
+        Install everything required by ``plan``, then apply its tags.
 
-    rm = RepositoryManager(pattern=VERSION_GLOB)
+        If any product fails to install, a RuntimeError listing those which
+        failed or were skipped as a result is raised once the tags have been
+        applied to everything which was installed.
+        """
+        with tracer.span("phase", "install"):
+            installed, failed, skipped = InstallScheduler(
+                self.stack_manager, self.repository_manager,
+                self.workers).install(plan.installs)
+        product_dirs = [self.stack_manager._product_dir(*pair)
+                        for pair in installed]
+        with tracer.span("phase", "finalize"):
+            self.stack_manager.finalize(product_dirs)
+        if DEDUPLICATE and product_dirs:
+            with tracer.span("phase", "deduplicate"):
+                self.stack_manager.deduplicate(product_dirs)
+        with tracer.span("phase", "apply tags"):
+            stack_tags = self.stack_manager.tags()
+            for tag in plan.tags:
+                if tag not in stack_tags:
+                    print("  Adding global tag %s" % (tag,))
+                    self.stack_manager.add_global_tag(tag)
+                print("  Applying tag %s" % (tag,))
+                self.stack_manager.apply_tags(
+                    self.repository_manager.products_for_tag(tag), tag)
+        if failed or skipped:
+            raise RuntimeError(
+                "Failed to install %s%s" %
+                (", ".join("%s %s" % pair for pair in failed),
+                 "; skipped %s" % (", ".join("%s %s" % pair
+                                             for pair in skipped),)
+                 if skipped else ""))
+
+
+def retained_tags(tag_dates, policy=RETENTION_POLICY):
+    """
+    Return the set of tags in ``tag_dates`` (a map from tag to date) which
+    are kept according to ``policy`` (see ``RETENTION_POLICY``).
+    """
+    if policy is None:
+        return set(tag_dates)
+    newest_first = sorted(tag_dates, key=lambda tag: tag_dates[tag],
+                          reverse=True)
+    retained = set()
+    matched = set()
+    for pattern, count in policy:
+        tags = [tag for tag in newest_first if re.match(pattern, tag)]
+        matched.update(tags)
+        retained.update(tags if count is None else tags[:count])
+    retained.update(set(tag_dates) - matched)
+    return retained
+
+
+def update_stack(sm, rm, retention_dry_run=False):
+    """
+    Install any tags of ``PRODUCTS`` which are available from the
+    RepositoryManager ``rm`` but not in the stack managed by the StackManager
+    ``sm``, then tag the most recent of each as "current".
 
+    Tags are then pruned according to ``RETENTION_POLICY``; if
+    ``retention_dry_run`` is ``True``, we only report what would be removed.
+    """
+    retained = retained_tags(rm.tag_dates)
     for product in PRODUCTS:
         print("Considering %s" % (product,))
-        server_tags = rm.tags_for_product(product)
+        server_tags = rm.tags_for_product(product) & retained
         installed_tags = sm.tags_for_product(product)
-        candidate_tags = server_tags - installed_tags
-
-        for tag in candidate_tags:
-            print("  Installing %s tagged %s" % (product, tag))
-            sm.distrib_install(product, tag=tag)
-            if tag not in sm.tags():
-                print("  Adding global tag %s" % (tag,))
-                sm.add_global_tag(tag)
-
-            print("  Applying tag %s" % (tag,))
-            for sub_product, version in rm.products_for_tag(tag):
-                sm.apply_tag(sub_product, version, tag)
+        # The repository may assume that product is in every tag (see
+        # LazyRepositoryManager), so check that it really is.
+        candidate_tags = set(
+            tag for tag in server_tags - installed_tags
+            if any(name == product
+                   for name, version in rm.products_for_tag(tag)))
+
+        if candidate_tags:
+            planner = InstallPlanner(sm, rm)
+            with tracer.span("phase", "plan"):
+                plan = planner.plan(sorted(candidate_tags,
+                                           key=lambda tag: rm.tag_dates[tag]),
+                                    [product])
+            print(plan.describe())
+            planner.execute(plan)
 
         # Tag as current based on date ordering on server.
         available_tags = server_tags.intersection(sm.tags_for_product(product))
@@ -585,13 +3580,185 @@ def main(stack_dir):
             current_tag = max(available_tags,
                               key=lambda tag: rm.tag_dates[tag])
             print("  Marking %s %s as current" % (product, current_tag))
-            for sub_product, version in rm.products_for_tag(current_tag):
-                sm.apply_tag(sub_product, version, "current")
+            with tracer.span("phase", "mark current"):
+                sm.apply_tags(rm.products_for_tag(current_tag), "current")
+
+    # Tags on the server which are no longer retained are removed from the
+    # stack; tags not on the server (including "current") are left alone.
+    with tracer.span("phase", "prune"):
+        sm.prune_tags(set(rm.tag_dates) - retained,
+                      dry_run=retention_dry_run)
+
+    with tracer.span("phase", "fast loaders"):
+        sm.write_fast_loaders()
+
+
+def update_stacks(stack_managers, rm, retention_dry_run=False):
+    """
+    Run ``update_stack()`` on each of ``stack_managers`` (a list of
+    StackManagers) at the same time, all using the RepositoryManager ``rm``.
+
+    A failure to update one stack does not stop the others; a RuntimeError
+    is raised once they have all finished if any failed.
+    """
+    if len(stack_managers) == 1:
+        update_stack(stack_managers[0], rm, retention_dry_run)
+        return
+
+    def update(sm):
+        try:
+            print("Updating %s" % (sm.stack_dir,))
+            update_stack(sm, rm, retention_dry_run)
+        except Exception:
+            traceback.print_exc()
+            return sm.stack_dir
+
+    failed = [stack_dir for stack_dir in threaded_imap(update, stack_managers,
+                                                       len(stack_managers))
+              if stack_dir]
+    if failed:
+        raise RuntimeError("Failed to update %s" % (", ".join(failed),))
+
+
+def main(stack_dirs, trace=None, pkgroot=EUPS_PKGROOT, watch=None,
+         retention_dry_run=False):
+    """
+    Create or update the stacks in ``stack_dirs`` (a list of directories, or
+    a single directory) from the distribution server ``pkgroot``.
+
+    The server is read once, and the stacks are updated at the same time.
+    Each has its own EUPS user data; the EUPS Python API (see
+    ``EUPS_IN_PROCESS``) is only used when there is a single stack, since
+    EUPS can only be imported from one stack in a process.
+
+    If ``trace`` is given, record the time spent in each phase of the run,
+    in subprocesses and in HTTP requests, and write the results to
+    ``trace.json`` (a summary) and ``trace.trace.json`` (a Chrome trace).
+
+    If ``watch`` is given, keep running after the update, checking the
+    server for new tags every ``watch`` seconds and updating the stacks
+    whenever any appear. Failures are then reported and retried, backing off
+    up to ``WATCH_MAX_INTERVAL`` seconds, rather than ending the run.
 
-    shutil.rmtree(userdata)
+    If ``retention_dry_run`` is ``True``, report the tags and product
+    versions which ``RETENTION_POLICY`` would remove, but leave them be.
+    """
+    if isinstance(stack_dirs, str):
+        stack_dirs = [stack_dirs]
+    if trace:
+        tracer.enable()
+    try:
+        _main(stack_dirs, pkgroot, watch, retention_dry_run)
+    finally:
+        if trace:
+            tracer.write(trace)
+
+
+def _main(stack_dirs, pkgroot, watch, retention_dry_run):
+    # We create a temporary directory for the EUPS cache etc of each stack.
+    # This means we can run multiple instances of StackManager simultaneously
+    # without them clobbering each other.
+    userdata_dirs = [tempfile.mkdtemp() for stack_dir in stack_dirs]
+    in_process = EUPS_IN_PROCESS and len(stack_dirs) == 1
+
+    def load_stack(args):
+        stack_dir, userdata = args
+        # If the stack doesn't already exist, create it.
+        if not os.path.exists(stack_dir):
+            with tracer.span("phase", "create stack"):
+                artifact_cache = None
+                if ARTIFACT_CACHE_DIR:
+                    artifact_cache = ArtifactCache(ARTIFACT_CACHE_DIR)
+                sm = StackManager.create_stack(stack_dir, pkgroot=pkgroot,
+                                               userdata=userdata,
+                                               in_process=in_process,
+                                               artifact_cache=artifact_cache)
+                if artifact_cache:
+                    artifact_cache.prune()
+        else:
+            with tracer.span("phase", "load stack"):
+                sm = StackManager(stack_dir, pkgroot=pkgroot,
+                                  userdata=userdata, in_process=in_process)
+        return sm
+
+    try:
+        stack_managers = list(threaded_imap(
+            load_stack, list(zip(stack_dirs, userdata_dirs)),
+            len(stack_dirs)))
+
+        with tracer.span("phase", "load repository"):
+            if HTTP_CACHE_DIR:
+                cache = HTTPCache(HTTP_CACHE_DIR)
+            else:
+                cache = None
+            if LAZY_REPOSITORY:
+                rm = LazyRepositoryManager(pkgroot, pattern=VERSION_GLOB,
+                                           cache=cache)
+            else:
+                rm = RepositoryManager(pkgroot, pattern=VERSION_GLOB,
+                                       cache=cache,
+                                       snapshot=REPOSITORY_SNAPSHOT)
+            if cache:
+                cache.prune()
+
+        if not watch:
+            update_stacks(stack_managers, rm, retention_dry_run)
+            return
+
+        # In watch mode, all the managers are kept, so that each poll costs
+        # only a (conditional) request for the tag index. The stacks are
+        # re-read before updating in case they have been modified by others.
+        # Failures are reported and retried, rather than ending the run.
+        stack_states, update_pending, failures = None, True, 0
+        while True:
+            if update_pending:
+                if stack_states:
+                    for sm, stack_state in zip(stack_managers, stack_states):
+                        sm.refresh_since(stack_state)
+                try:
+                    update_stacks(stack_managers, rm, retention_dry_run)
+                except Exception:
+                    traceback.print_exc()
+                    failures += 1
+                else:
+                    update_pending, failures = False, 0
+                stack_states = [sm._ups_db_state() for sm in stack_managers]
+
+            time.sleep(min(watch * 2 ** min(failures, 16),
+                           max(watch, WATCH_MAX_INTERVAL)))
+            try:
+                with tracer.span("phase", "poll"):
+                    new_tags = rm.refresh()
+            except Exception as e:
+                print("Failed to check %s for new tags: %s" % (pkgroot, e))
+                failures += 1
+                continue
+            if new_tags:
+                print("New or modified tags: %s" % (", ".join(new_tags),))
+                update_pending = True
+            elif not update_pending:
+                failures = 0
+    finally:
+        for userdata in userdata_dirs:
+            shutil.rmtree(userdata)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(description="Maintain a shared EUPS stack.")
-    parser.add_argument('--root', help="target directory", default=ROOT)
-    main(parser.parse_args().root)
+    parser.add_argument('--root', action="append", dest="roots",
+                        metavar="ROOT",
+                        help="target directory; may be given more than once "
+                             "to maintain several stacks (default: %s)" %
+                             (ROOT,))
+    parser.add_argument('--trace', metavar="PREFIX",
+                        help="write timing information to PREFIX.json and "
+                             "a Chrome trace to PREFIX.trace.json")
+    parser.add_argument('--watch', metavar="SECONDS", type=float,
+                        help="after updating, keep checking the server for "
+                             "new tags at this interval")
+    parser.add_argument('--retention-dry-run', action="store_true",
+                        help="report what RETENTION_POLICY would remove "
+                             "from the stack without removing it")
+    args = parser.parse_args()
+    main(args.roots or [ROOT], trace=args.trace, watch=args.watch,
+         retention_dry_run=args.retention_dry_run)
@@ -7,12 +7,7 @@ import tempfile
 import platform
 import os
 
-try:
-    # Python 3
-    from urllib.request import urlopen
-except ImportError:
-    # Python 2
-    from urllib2 import urlopen
+from shared_stack import http_client, parse_tag_index, parse_tag_list
 
 EUPS_PKGROOT = "https://sw.lsstcorp.org/eupspkg/"
 VERSION_GLOB = r"w_2016_\d\d|v12_\d(_rc\d)?"
@@ -157,37 +152,27 @@ class RepositoryManager(object):
         self.tag_dates = {}
         self.pkgroot = pkgroot
 
-        h = urlopen(pkgroot + "tags/")
-        for tagline in h.read().decode('utf-8').strip().split('\n'):
-            ws = tagline.split('"')
-            if len(ws) > 5:
-                tag = ws[6][1:]
-                if '.list' not in tag:
-                    continue
-                if not re.match(pattern, tag):
-                    continue
+        h = http_client.urlopen(pkgroot + "tags/")
+        for href, tag, description in parse_tag_index(h):
+            if '.list' not in tag:
+                continue
+            if not re.match(pattern, tag):
+                continue
 
-                tag = tag.split('.list')[0]
+            tag = tag.split('.list')[0]
 
-                print("-----------------", tag)
+            print("-----------------", tag)
 
-                try:
-                    u = urlopen("https://sw.lsstcorp.org/eupspkg/tags/%s.list" % tag)
-                except:
-                    continue
+            try:
+                u = http_client.urlopen("https://sw.lsstcorp.org/eupspkg/tags/%s.list" % tag)
+            except:
+                continue
 
-                # tag_date = datetime.strptime(u.info()['last-modified'], "%a, %d %b %Y %H:%M:%S %Z")
+            # tag_date = datetime.strptime(u.info()['last-modified'], "%a, %d %b %Y %H:%M:%S %Z")
 
-                for line in u.read().decode('utf-8').strip().split('\n'):
-
-                    if "EUPS distribution " in line:
-                        continue
-                    if line.strip()[0] == "#":
-                        continue
-
-                    product, flavor, version = line.split()
-                    print('>', product, flavor, version)
-                    self._product_tracker.insert(product, version)
+            for product, version in parse_tag_list(u, tag):
+                print('>', product, version)
+                self._product_tracker.insert(product, version)
 
     def tags_for_product(self, product_name):
         return self._product_tracker.tags_for_product(product_name)